@@ -0,0 +1,263 @@
+"""
+delta bundles of the mirror, to carry it to an isolated network
+a bundle is a tar stream (or a set of volumes) with the artifacts added since
+a generation, the catalog, the assets and the list of removed artifacts
+"""
+
+import json
+import logging
+import os
+import pathlib
+import shutil
+import sys
+
+BUNDLE_FILE = "bundle.json"
+STAGING_DIR = ".import"
+
+# applied last: once they are replaced, the mirror is at the new generation
+LAST_FILES = [
+    "catalog/index.json",
+    "extensions.md",
+    "changes.json",
+    "data.json",
+    "inventory.json",
+]
+
+
+def metadata_files(root):
+    """
+    return the files of the web root that are not artifacts: catalog, inventory,
+    assets, pages of index.html and Go tools
+    """
+    names = []
+    for f in sorted(root.iterdir()):
+        if f.is_file() and not f.name.endswith((".part", ".tmp")):
+            names.append(f.name)
+    for d in ("images", "catalog"):
+        for f in sorted((root / d).glob("**/*")):
+            if f.is_file():
+                names.append(f.relative_to(root).as_posix())
+    names.sort(key=lambda name: LAST_FILES.index(name) if name in LAST_FILES else -1)
+    return names
+
+
+def code_aliases(root):
+    """
+    return the aliases of the Code commit directories (latest, version numbers)
+    """
+    return {
+        f.relative_to(root).as_posix(): os.readlink(f)
+        for f in sorted((root / "code").glob("*"))
+        if f.is_symlink()
+    }
+
+
+def split_volumes(root, artifacts, metadata, volume_size):
+    """
+    spread the files into volumes of at most `volume_size` bytes
+    a larger file has its own volume, the metadata files are in the last one
+    """
+    volumes = [[]]
+    size = 0
+    for name in artifacts:
+        file_size = (root / name).stat().st_size
+        if volume_size and volumes[-1] and size + file_size > volume_size:
+            volumes.append([])
+            size = 0
+        volumes[-1].append(name)
+        size += file_size
+    volumes[-1].extend(metadata)
+    return volumes
+
+
+def add_json(tar, name, data):
+    import io
+    import tarfile
+    import time
+
+    raw = json.dumps(data, indent=4).encode()
+    info = tarfile.TarInfo(name)
+    info.size = len(raw)
+    info.mtime = int(time.time())
+    tar.addfile(info, io.BytesIO(raw))
+
+
+def export_bundle(root, inventory, since, output=None, volume_size=None):
+    """
+    write the changes of the mirror after the generation `since`
+    return the paths of the volumes written
+    """
+    import tarfile
+
+    root = pathlib.Path(root)
+    added, removed = inventory.changes(since)
+    added = [name for name in added if (root / name).is_file()]
+    if since >= inventory.generation:
+        logging.warning("no change after generation %d", since)
+
+    volumes = split_volumes(root, added, metadata_files(root), volume_size)
+    header = {
+        "since": since,
+        "generation": inventory.generation,
+        "volumes": len(volumes),
+        "deleted": removed,
+        "aliases": code_aliases(root),
+    }
+
+    if output is None:
+        output = f"vscode-dl-{since}-{inventory.generation}.tar"
+
+    written = []
+    for number, names in enumerate(volumes, 1):
+        volume = dict(header, volume=number, files=names)
+
+        if output == "-":
+            # a single stream
+            f = sys.stdout.buffer
+            tar = tarfile.open(fileobj=f, mode="w|")
+        else:
+            path = output
+            if volume_size:
+                path = f"{output}.{number:03}"
+            f = open(path + ".part", "wb")
+            tar = tarfile.open(fileobj=f, mode="w|")
+
+        with tar:
+            add_json(tar, BUNDLE_FILE, volume)
+            for name in names:
+                tar.add(str(root / name), arcname=name, recursive=False)
+
+        if output != "-":
+            f.close()
+            os.replace(path + ".part", path)
+            written.append(path)
+            logging.info("volume %d/%d written into %s", number, len(volumes), path)
+
+    logging.info(
+        "generations %d to %d: %d artifacts, %d removed",
+        since,
+        inventory.generation,
+        len(added),
+        len(removed),
+    )
+    return written
+
+
+def check_member(member):
+    """
+    refuse the members that would be written out of the web root
+    """
+    path = pathlib.PurePosixPath(member.name)
+    if not member.isfile() or path.is_absolute() or ".." in path.parts:
+        raise ValueError(f"unexpected member in bundle: {member.name}")
+
+
+def read_volume(path, staging):
+    """
+    extract a volume into the staging directory
+    return its header
+    """
+    import tarfile
+
+    if path == "-":
+        tar = tarfile.open(fileobj=sys.stdin.buffer, mode="r|")
+    else:
+        tar = tarfile.open(path, mode="r|")
+
+    header = None
+    with tar:
+        for member in tar:
+            if header is None:
+                if member.name != BUNDLE_FILE:
+                    raise ValueError(f"{path} is not a vscode-dl bundle")
+                header = json.load(tar.extractfile(member))
+                continue
+            check_member(member)
+            dest = staging / member.name
+            dest.parent.mkdir(parents=True, exist_ok=True)
+            with tar.extractfile(member) as src, dest.open("wb") as dst:
+                shutil.copyfileobj(src, dst)
+            os.utime(dest, (member.mtime, member.mtime))
+
+    if header is None:
+        raise ValueError(f"{path} is empty")
+    return header
+
+
+def import_bundles(root, paths, generation):
+    """
+    apply the volumes of a bundle to a mirror at `generation`
+    all volumes are extracted and checked before the mirror is modified: new
+    artifacts are moved into place first, then the catalog, and the removed
+    artifacts are deleted last, so clients always see a consistent mirror
+    return the new generation
+    """
+    root = pathlib.Path(root)
+    staging = root / STAGING_DIR
+    shutil.rmtree(staging, ignore_errors=True)
+    staging.mkdir()
+
+    try:
+        headers = [read_volume(path, staging) for path in paths]
+
+        first = headers[0]
+        for header in headers:
+            if (header["since"], header["generation"]) != (
+                first["since"],
+                first["generation"],
+            ):
+                raise ValueError("volumes of different bundles")
+        missing = set(range(1, first["volumes"] + 1)) - set(
+            header["volume"] for header in headers
+        )
+        if missing:
+            raise ValueError("missing volumes: " + " ".join(map(str, sorted(missing))))
+
+        if first["generation"] <= generation:
+            logging.info(
+                "generation %d is already imported (mirror at %d)",
+                first["generation"],
+                generation,
+            )
+            return generation
+        if first["since"] > generation:
+            raise ValueError(
+                "the bundle starts at generation {} but the mirror is at {}".format(
+                    first["since"], generation
+                )
+            )
+
+        files = [name for header in headers for name in header["files"]]
+        for name in files:
+            if not (staging / name).is_file():
+                raise ValueError(f"missing file in bundle: {name}")
+        files.sort(
+            key=lambda name: LAST_FILES.index(name) if name in LAST_FILES else -1
+        )
+
+        for name in files:
+            dest = root / name
+            dest.parent.mkdir(parents=True, exist_ok=True)
+            os.replace(staging / name, dest)
+
+        for name, target in first["aliases"].items():
+            tmp = root / (name + ".tmp")
+            if tmp.is_symlink():
+                tmp.unlink()
+            tmp.symlink_to(target, target_is_directory=True)
+            os.replace(tmp, root / name)
+
+        for name in first["deleted"]:
+            if (root / name).is_file():
+                (root / name).unlink()
+
+        logging.info(
+            "generation %d imported: %d files, %d removed",
+            first["generation"],
+            len(files),
+            len(first["deleted"]),
+        )
+        return first["generation"]
+
+    finally:
+        shutil.rmtree(staging, ignore_errors=True)
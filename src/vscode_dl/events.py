@@ -0,0 +1,150 @@
+"""
+structured progress events, written as JSON lines
+"""
+
+import json
+import sys
+import threading
+import time
+
+# minimal delay between two bytes_transferred events for the same artifact
+TRANSFER_INTERVAL = 0.5
+
+
+class Events:
+    """
+    emit typed progress events with cumulative throughput
+    the stream is disabled (every call is a no-op) until configure() is called
+    """
+
+    def __init__(self, stream=None):
+        self.stream = stream
+        self.lock = threading.Lock()
+        self.reset()
+
+    @property
+    def enabled(self):
+        return self.stream is not None
+
+    def reset(self):
+        """
+        reset the counters
+        """
+        self.start = time.monotonic()
+        self.bytes_total = 0
+        self.bytes_expected = 0
+        self.queued = 0
+        self.started = 0
+        self.done = 0
+        self.failed = 0
+        self.last_emit = {}
+
+    def throughput(self):
+        """
+        cumulative throughput and estimated time of arrival
+        """
+        elapsed = time.monotonic() - self.start
+        rate = self.bytes_total / elapsed if elapsed > 0 else 0.0
+
+        # artifacts not yet started are estimated with the average size of the finished ones
+        remaining = max(self.bytes_expected - self.bytes_total, 0)
+        pending = self.queued - self.started
+        if pending > 0 and self.done > 0:
+            remaining += pending * self.bytes_total // self.done
+
+        data = {
+            "elapsed": round(elapsed, 3),
+            "bytes": self.bytes_total,
+            "rate": round(rate, 1),
+            "queued": self.queued,
+            "done": self.done,
+            "failed": self.failed,
+        }
+        if rate > 0:
+            data["eta"] = round(remaining / rate, 1)
+        return data
+
+    def emit(self, event, **fields):
+        """
+        write one event
+        """
+        if self.stream is None:
+            return
+        record = {"event": event, "time": round(time.time(), 3)}
+        record.update(fields)
+        line = json.dumps(record, separators=(",", ":"), default=str)
+        with self.lock:
+            self.stream.write(line + "\n")
+            self.stream.flush()
+
+    def query_started(self, query, count):
+        self.emit("query_started", query=query, count=count)
+
+    def query_finished(self, query, count):
+        self.emit("query_finished", query=query, count=count)
+
+    def artifact_queued(self, key, url, path):
+        if self.stream is None:
+            return
+        with self.lock:
+            self.queued += 1
+        self.emit("artifact_queued", key=key, url=url, path=str(path))
+
+    def artifact_started(self, key, size):
+        if self.stream is None:
+            return
+        with self.lock:
+            self.started += 1
+            self.bytes_expected += size or 0
+            self.last_emit[key] = time.monotonic()
+        self.emit("artifact_started", key=key, size=size)
+
+    def bytes_transferred(self, key, count):
+        if self.stream is None:
+            return
+        now = time.monotonic()
+        with self.lock:
+            self.bytes_total += count
+            if now - self.last_emit.get(key, 0) < TRANSFER_INTERVAL:
+                return
+            self.last_emit[key] = now
+            stats = self.throughput()
+        self.emit("bytes_transferred", key=key, **stats)
+
+    def artifact_done(self, key, ok, size=None, status=None):
+        if self.stream is None:
+            return
+        with self.lock:
+            if ok:
+                self.done += 1
+            else:
+                self.failed += 1
+            self.last_emit.pop(key, None)
+            stats = self.throughput()
+        self.emit("artifact_done", key=key, ok=ok, size=size, status=status, **stats)
+
+    def phase_done(self, phase):
+        if self.stream is None:
+            return
+        with self.lock:
+            stats = self.throughput()
+        self.emit("phase_done", phase=phase, **stats)
+
+
+# the process-wide event stream
+events = Events()
+
+
+def configure(fmt, output="-"):
+    """
+    enable the event stream
+    return True if the events are written to stdout
+    """
+    if fmt != "jsonl":
+        return False
+    if output == "-":
+        events.stream = sys.stdout
+    else:
+        events.stream = open(output, "a", encoding="utf-8", buffering=1)
+    events.reset()
+    return output == "-"
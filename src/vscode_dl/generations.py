@@ -0,0 +1,165 @@
+"""
+atomic publishing of the web root
+
+the web root is a symbolic link to a generation directory: each sync builds a
+new generation, where the unchanged files are hard links to the previous one,
+then the link is swapped atomically
+clients that are downloading from the previous generation are not disturbed:
+it is removed at a later sync
+"""
+
+import filecmp
+import logging
+import os
+import pathlib
+import shutil
+
+# the Go workspace is moved from one generation to the next one, since it is
+# updated in place by go get
+MOVED_DIRS = ["go"]
+
+# leftovers of interrupted writes and imports
+SKIPPED = (".part", ".tmp", ".import")
+
+
+def link_tree(src, dst):
+    """
+    copy a directory tree with hard links
+    """
+    for dirpath, dirnames, filenames in os.walk(src):
+        rel = os.path.relpath(dirpath, src)
+        target = os.path.join(dst, rel)
+        os.makedirs(target, exist_ok=True)
+
+        if rel == ".":
+            dirnames[:] = [d for d in dirnames if d not in MOVED_DIRS]
+
+        # os.walk does not follow the links to directories
+        for name in dirnames + filenames:
+            if name.endswith(SKIPPED):
+                continue
+            path = os.path.join(dirpath, name)
+            if os.path.islink(path):
+                os.symlink(os.readlink(path), os.path.join(target, name))
+            elif name in filenames:
+                os.link(path, os.path.join(target, name))
+
+        dirnames[:] = [
+            d
+            for d in dirnames
+            if not d.endswith(SKIPPED) and not os.path.islink(os.path.join(dirpath, d))
+        ]
+
+
+class Generations:
+    """
+    the generation directories of a web root, in <root>.generations/
+    """
+
+    def __init__(self, root, keep=1):
+        self.root = pathlib.Path(root)
+        self.dir = self.root.with_name(self.root.name + ".generations")
+        self.keep = keep
+        self.work = None
+
+    def current(self):
+        """
+        return the directory of the published generation
+        """
+        return self.root.resolve()
+
+    def prepare(self):
+        """
+        build the working directory of the next generation
+        """
+        current = self.current()
+        self.dir.mkdir(exist_ok=True)
+        self.work = self.dir / "next.tmp"
+        if self.work.exists():
+            shutil.rmtree(self.work)
+
+        link_tree(current, self.work)
+        for d in MOVED_DIRS:
+            if (current / d).is_dir():
+                os.rename(current / d, self.work / d)
+
+        logging.debug("new generation prepared in %s", self.work)
+        return self.work
+
+    def is_modified(self, ignored=()):
+        """
+        tell if a file of the working directory differs from the published
+        generation: the unchanged files are still hard links
+        """
+        current = self.current()
+        for dirpath, dirnames, filenames in os.walk(self.work):
+            rel = os.path.relpath(dirpath, self.work)
+            if rel == ".":
+                dirnames[:] = [d for d in dirnames if d not in MOVED_DIRS]
+                filenames = [f for f in filenames if f not in ignored]
+            for name in filenames:
+                path = os.path.join(dirpath, name)
+                old = os.path.join(current, rel, name)
+                if name.endswith(SKIPPED) or os.path.islink(path):
+                    continue
+                if not os.path.isfile(old):
+                    return True
+                if os.path.samefile(path, old):
+                    continue
+                if not filecmp.cmp(path, old, shallow=False):
+                    return True
+        return False
+
+    def discard(self):
+        """
+        drop the working directory: nothing is published
+        """
+        current = self.current()
+        for d in MOVED_DIRS:
+            if (self.work / d).is_dir() and not (current / d).exists():
+                os.rename(self.work / d, current / d)
+        shutil.rmtree(self.work)
+        self.work = None
+
+    def publish(self, generation):
+        """
+        swap the web root to the working directory
+        """
+        path = self.dir / f"{generation:06}"
+        os.rename(self.work, path)
+        self.work = None
+
+        tmp = self.root.with_name(self.root.name + ".tmp")
+        if tmp.is_symlink():
+            tmp.unlink()
+        tmp.symlink_to(os.path.relpath(path, self.root.parent))
+
+        if not self.root.is_symlink():
+            # first publication: the web root becomes a generation too.
+            # A directory cannot be replaced by a symlink in one step: the root
+            # is missing between the two renames, so migrate while it is idle.
+            previous = self.dir / f"{generation - 1:06}"
+            os.rename(self.root, previous)
+            try:
+                os.replace(tmp, self.root)
+            except OSError:
+                os.rename(previous, self.root)
+                raise
+        else:
+            os.replace(tmp, self.root)
+        logging.info("generation %d published in %s", generation, path)
+
+        self.prune(path)
+
+    def prune(self, current):
+        """
+        remove the old generations, except the `keep` previous ones
+        """
+        generations = sorted(
+            (d for d in self.dir.iterdir() if d.name.isdigit() and d != current),
+            key=lambda d: int(d.name),
+        )
+        old = generations[: -self.keep] if self.keep > 0 else generations
+        for d in old:
+            logging.debug("remove generation %s", d.name)
+            shutil.rmtree(d)
@@ -19,12 +19,16 @@ import pathlib
 import re
 import logging
 import textwrap
+import hashlib
+import shlex
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 
 ################################
 
 DEFAULT_URL = "."  # modified when tool is installed locally
 LOCAL_MODE = False  # True when tool is installed locally
-TOOL_VERSION = 35  # numerical value, strictly incremental
+TOOL_VERSION = 49  # numerical value, strictly incremental
 
 ################################
 
@@ -41,13 +45,115 @@ COLOR_GREEN = "\033[0;32m"
 COLOR_LIGHT_CYAN = "\033[1;36m"
 COLOR_END = "\033[0m"
 
+# maximum number of extensions and length of the arguments of a code command
+INSTALL_BATCH_SIZE = 20
+INSTALL_BATCH_LENGTH = 32000
+
+# number of extensions displayed by a search, by default
+SEARCH_PAGE_SIZE = 20
+
+# characters of the words of the search
+SEARCH_WORD_CHARS = "abcdefghijklmnopqrstuvwxyz0123456789"
+
+# extensions directories of Code and of the remote server
+EXTENSIONS_DIRS = ["~/.vscode/extensions", "~/.vscode-server/extensions"]
+
+# default size of the download cache, in MiB
+CACHE_SIZE = 2048
+
 # keep a reference to the temporaries files
 last_temporary_file = []
 
 
-def download_vsix(url, name):
+class Cache:
     """
-    download a remote file to a temporary one
+    persistent cache of the downloaded packages, keyed by name and checksum
+    it may be shared by several users or containers (CODE_TOOL_CACHE)
+    the least recently used packages are evicted when it is full
+    """
+
+    def __init__(self, path, max_size):
+        self.path = pathlib.Path(path)
+        self.max_size = max_size
+
+    def entry(self, name, sha256):
+        return self.path / sha256[:2] / (sha256 + "_" + pathlib.Path(name).name)
+
+    def lookup(self, name, sha256):
+        """
+        return the cached package, or None
+        """
+        path = self.entry(name, sha256)
+        if not path.is_file():
+            return None
+        try:
+            # the modification time is the last use
+            os.utime(str(path), None)
+        except OSError:
+            pass
+        logging.debug("cache hit %s", path)
+        return path.as_posix()
+
+    def store(self, name, sha256, stream):
+        """
+        copy a package into the cache, checking its checksum
+        return the cached package
+        """
+        path = self.entry(name, sha256)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        fp = tempfile.NamedTemporaryFile(dir=str(path.parent), suffix=".part", delete=False)
+        try:
+            h = hashlib.sha256()
+            with fp:
+                for chunk in iter(lambda: stream.read(1024 * 1024), b""):
+                    h.update(chunk)
+                    fp.write(chunk)
+            if h.hexdigest() != sha256:
+                raise ValueError("checksum mismatch for {}".format(name))
+            os.chmod(fp.name, 0o644)
+            os.replace(fp.name, str(path))
+        finally:
+            if os.path.exists(fp.name):
+                os.unlink(fp.name)
+        self.evict(path)
+        return path.as_posix()
+
+    def evict(self, keep):
+        """
+        remove the least recently used packages until the cache fits
+        """
+        files = []
+        for f in self.path.glob("*/*"):
+            try:
+                st = f.stat()
+            except OSError:
+                continue
+            files.append((st.st_mtime, st.st_size, f))
+        total = sum(size for _, size, _ in files)
+        for _, size, f in sorted(files, key=lambda x: x[0]):
+            if total <= self.max_size:
+                break
+            if f == keep:
+                continue
+            logging.debug("cache evict %s", f)
+            try:
+                f.unlink()
+                total -= size
+            except OSError:
+                pass
+
+
+# the download cache (None if disabled)
+cache = None
+
+# the extensions directory for the copy install (None if disabled)
+extensions_dir = None
+
+
+def download_vsix(url, name, sha256=None):
+    """
+    download a remote file to a temporary one, or into the cache if its
+    checksum is known
     return the filename
     """
 
@@ -56,6 +162,12 @@ def download_vsix(url, name):
         if scheme == "file":
             return pathlib.Path(path) / name
 
+        if cache is not None and sha256:
+            # no request at all for a cached package
+            cached = cache.lookup(name, sha256)
+            if cached:
+                return cached
+
         if path.endswith("/"):
             path += name
         else:
@@ -63,7 +175,9 @@ def download_vsix(url, name):
         uri = urllib.parse.urlunsplit((scheme, netloc, path, None, None))
 
         r = requests.get(uri, stream=True, allow_redirects=True)
-        if r.status_code == 200:
+        if r.status_code == 200 and cache is not None and sha256:
+            return cache.store(name, sha256, r.raw)
+        elif r.status_code == 200:
             fp = tempfile.NamedTemporaryFile(suffix=("_" + os.path.basename(name)))
             shutil.copyfileobj(r.raw, fp.file)
             fp.file.close()
@@ -72,7 +186,7 @@ def download_vsix(url, name):
         else:
             r.raise_for_status()
 
-    except requests.HTTPError as e:
+    except (requests.HTTPError, ValueError) as e:
         print("cannot download {}: {}{}{}".format(name, COLOR_RED, e, COLOR_END))
 
 
@@ -112,6 +226,218 @@ def load_resource(url, name, raw=False):
     return data
 
 
+def cache_files(url, cache_dir, name):
+    """
+    return the cached copy of a resource of the mirror and its validators
+    """
+    key = hashlib.sha256(url.encode()).hexdigest()[:16]
+    stem = pathlib.Path(name).stem
+    cache_dir = pathlib.Path(cache_dir)
+    return cache_dir / "{}-{}.json".format(stem, key), cache_dir / "{}-{}.meta".format(stem, key)
+
+
+def write_cache_file(file, content):
+    tmp = file.with_name(file.name + ".part")
+    tmp.write_bytes(content)
+    os.replace(str(tmp), str(file))
+
+
+def load_cached(url, name, cache_dir, quiet=False):
+    """
+    retrieve a JSON resource, revalidated against the copy kept in the cache
+    directory with a conditional request
+    """
+
+    scheme, netloc, path, _, _ = urllib.parse.urlsplit(url, scheme="file")
+    if scheme == "file":
+        if quiet and not (pathlib.Path(path) / name).exists():
+            return
+        return load_resource(url, name)
+
+    data_file, meta_file = cache_files(url, cache_dir, name)
+
+    try:
+        meta = json.loads(meta_file.read_text())
+        data = data_file.read_bytes()
+    except (OSError, ValueError):
+        meta = {}
+        data = None
+
+    if path.endswith("/"):
+        path += name
+    else:
+        path += "/" + name
+    uri = urllib.parse.urlunsplit((scheme, netloc, path, None, None))
+
+    headers = {}
+    if data is not None:
+        if meta.get("etag"):
+            headers["If-None-Match"] = meta["etag"]
+        if meta.get("last-modified"):
+            headers["If-Modified-Since"] = meta["last-modified"]
+
+    try:
+        r = requests.get(uri, headers=headers)
+        if r.status_code == 304 and data is not None:
+            logging.debug("%s not modified", name)
+            return json.loads(data.decode())
+        if quiet and r.status_code == 404:
+            return
+        r.raise_for_status()
+        data = r.content
+        result = json.loads(data.decode())
+
+    except requests.ConnectionError as e:
+        if not quiet:
+            print("cannot reach the mirror: {}{}{}".format(COLOR_RED, e, COLOR_END))
+            if data is not None:
+                print("use --offline to work with the cached data")
+        return
+
+    except Exception as e:
+        if not quiet:
+            print("cannot get resource {}: {}{}{}".format(name, COLOR_RED, e, COLOR_END))
+        return
+
+    # keep the copy for the next runs, the validators are written last
+    meta = {
+        "etag": r.headers.get("ETag"),
+        "last-modified": r.headers.get("Last-Modified"),
+        "date": r.headers.get("Date"),
+    }
+    try:
+        data_file.parent.mkdir(parents=True, exist_ok=True)
+        if meta_file.exists():
+            meta_file.unlink()
+        write_cache_file(data_file, data)
+        write_cache_file(meta_file, json.dumps(meta).encode())
+    except OSError as e:
+        logging.debug("cannot cache %s: %s", name, e)
+
+    return result
+
+
+def apply_changes(data, changes):
+    """
+    bring a catalog up to date with the entries of the changes feed
+    return False if the feed does not cover the generation of the catalog
+    """
+
+    generation = data.get("generation")
+    if generation is None or changes["since"] > generation:
+        return False
+
+    for entry in changes["entries"]:
+        if entry["generation"] <= generation:
+            continue
+        for key, value in entry.items():
+            if key in ("generation", "extensions"):
+                continue
+            if value is None:
+                data.pop(key, None)
+            else:
+                data[key] = value
+        for key, value in entry["extensions"].items():
+            if value is None:
+                data["extensions"].pop(key, None)
+            else:
+                data["extensions"][key] = value
+
+    data["generation"] = changes["generation"]
+    return True
+
+
+def load_data(url, cache_dir, offline=False):
+    """
+    retrieve data.json and the changes feed
+    data.json is kept in the cache directory: it is brought up to date with
+    the changes feed, revalidated with a conditional request, or taken as is
+    in offline mode
+    """
+
+    scheme, _, _, _, _ = urllib.parse.urlsplit(url, scheme="file")
+    data_file, meta_file = cache_files(url, cache_dir, "data.json")
+
+    if offline:
+        try:
+            data = json.loads(data_file.read_text())
+        except (OSError, ValueError):
+            print("no cached data for {}".format(url))
+            return None, None
+        print("\033[2moffline: data of generation {}\033[0m".format(data.get("generation", "?")))
+        return data, None
+
+    changes = load_cached(url, "changes.json", cache_dir, quiet=True)
+
+    if changes is not None and scheme != "file":
+        try:
+            data = json.loads(data_file.read_text())
+        except (OSError, ValueError):
+            data = None
+
+        if data is not None and data.get("generation") == changes["generation"]:
+            # nothing has changed: data.json is not requested
+            logging.debug("data.json is at generation %d", changes["generation"])
+            return data, changes
+
+        if data is not None and apply_changes(data, changes):
+            logging.debug("data.json updated to generation %d", changes["generation"])
+            try:
+                # the validators are the ones of an older data.json
+                if meta_file.exists():
+                    meta_file.unlink()
+                write_cache_file(data_file, json.dumps(data).encode())
+            except OSError as e:
+                logging.debug("cannot cache data.json: %s", e)
+            return data, changes
+
+    return load_cached(url, "data.json", cache_dir), changes
+
+
+def changed_extensions(url, cache_dir, changes):
+    """
+    return the keys (in lowercase) of the extensions changed since the last
+    generation applied by an update, or None if they are unknown
+    """
+
+    if changes is None:
+        return None
+    generation = read_applied_generation(url, cache_dir)
+    if generation is None or changes["since"] > generation:
+        return None
+
+    changed = set(read_failed_extensions(url, cache_dir))
+    for entry in changes["entries"]:
+        if entry["generation"] > generation:
+            changed.update(key.lower() for key in entry["extensions"])
+    return changed
+
+
+def read_applied_generation(url, cache_dir):
+    file, _ = cache_files(url, cache_dir, "applied.json")
+    try:
+        return json.loads(file.read_text())["generation"]
+    except (OSError, ValueError, KeyError):
+        return None
+
+
+def read_failed_extensions(url, cache_dir):
+    file, _ = cache_files(url, cache_dir, "applied.json")
+    try:
+        return json.loads(file.read_text()).get("failed", [])
+    except (OSError, ValueError, AttributeError):
+        return []
+
+
+def write_applied_generation(url, cache_dir, generation, failed=()):
+    file, _ = cache_files(url, cache_dir, "applied.json")
+    try:
+        file.parent.mkdir(parents=True, exist_ok=True)
+        write_cache_file(file, json.dumps({"generation": generation, "failed": sorted(failed)}).encode())
+    except OSError as e:
+        logging.debug("cannot write the applied generation: %s", e)
+
+
 def update_code(url, dry_run, platform, data):
     """
     install or update Visual Studio Code
@@ -161,7 +487,7 @@ def update_code(url, dry_run, platform, data):
                 )
             )
         if not dry_run:
-            deb = download_vsix(url, code["url"])
+            deb = download_vsix(url, code["url"], code.get("sha256"))
             if deb:
                 # call dpkg to install the .deb
                 cmd = ["dpkg", "-i", deb]
@@ -213,14 +539,18 @@ def print_cmd(cmd):
     print("\033[2mexec: {}\033[0m".format(s))
 
 
-def update_go_tools(url, dry_run, tools):
+def update_go_tools(url, dry_run, tools, go_proxy=None, jobs=4):
     """
     mirror and build Go tools
     """
     print("\033[95mSyncing Go tools...\033[0m")
 
     if not url.startswith("http") and not url.startswith("ftp"):
-        url = "file://" + url
+        url = "file://" + pathlib.Path(url).absolute().as_posix()
+
+    if go_proxy:
+        install_go_tools(url.rstrip("/") + "/" + go_proxy, dry_run, tools, jobs)
+        return
 
     # get the archive and untar it
     cmd = "curl -skL {}/go-tools.tar.gz | tar -xzf -".format(url)
@@ -242,35 +572,329 @@ def update_go_tools(url, dry_run, tools):
             print_cmd(cmd)
 
 
-def install_extension(url, vsix, dry_run):
+def install_go_tools(proxy, dry_run, tools, jobs):
     """
-    install an extension
+    install Go tools from the module proxy of the mirror
+    the go command downloads only the modules missing from its cache
     """
 
+    env = os.environ.copy()
+    env["GOPROXY"] = proxy
+    # the modules have been checked by the mirror
+    env["GOSUMDB"] = "off"
+    env["GO111MODULE"] = "on"
+
+    cmds = [["go", "install", tool["importPath"] + "@latest"] for tool in tools.values()]
     if dry_run:
-        cmd = "code --install-extension '{}'".format(pathlib.Path(vsix).name)
-        print(COLOR_GREEN + cmd + COLOR_END)
-    else:
-        vsix_path = download_vsix(url, vsix)
-        if vsix_path:
-            cmd = "code --install-extension '{}'".format(vsix_path)
-            try:
-                s = subprocess.check_output(cmd, shell=True)
-                print("\033[2m" + s.decode() + "\033[0m")
-            except subprocess.CalledProcessError as e:
-                print("error:", e)
+        print_cmd(["GOPROXY=" + proxy, "GOSUMDB=off"])
+        for cmd in cmds:
+            print_cmd(cmd)
+        return
+
+    def install(cmd):
+        return cmd, subprocess.call(cmd, env=env)
+
+    with ThreadPoolExecutor(max_workers=max(jobs, 1)) as pool:
+        for cmd, rc in pool.map(install, cmds):
+            print("installing: \033[1;36m{}\033[0m {}".format(cmd[2], [HEAVY_BALLOT_X, CHECK_MARK][rc == 0]))
+
+
+def install_command(vsix_paths, code="code"):
+    """
+    return the code command line that installs extensions
+    """
+    return code + " " + " ".join("--install-extension " + shlex.quote(str(p)) for p in vsix_paths)
+
+
+def install_batches(vsix_paths):
+    """
+    split extensions into batches with a bounded command line
+    """
+    batch = []
+    length = 0
+    for vsix_path in vsix_paths:
+        size = len(str(vsix_path)) + 24
+        if batch and (len(batch) >= INSTALL_BATCH_SIZE or length + size > INSTALL_BATCH_LENGTH):
+            yield batch
+            batch = []
+            length = 0
+        batch.append(vsix_path)
+        length += size
+    if batch:
+        yield batch
+
+
+def install_vsix(vsix_paths, code="code"):
+    """
+    install downloaded extensions with a single code process
+    return True if all extensions have been installed
+    """
+
+    try:
+        s = subprocess.check_output(install_command(vsix_paths, code), shell=True, stderr=subprocess.STDOUT)
+        print("\033[2m" + s.decode() + "\033[0m")
+        return True
+    except subprocess.CalledProcessError as e:
+        if len(vsix_paths) == 1:
+            name = pathlib.Path(vsix_paths[0]).name
+            print("error: cannot install {} {}".format(name, HEAVY_BALLOT_X))
+            print("\033[2m" + e.output.decode() + "\033[0m")
+        return False
+
+
+def install_vsix_batches(vsix_paths, code="code"):
+    """
+    install extensions by batches
+    when a batch fails, its extensions are installed one by one to find the culprits
+    return the extensions that have not been installed
+    """
+
+    failed = []
+    for batch in install_batches(vsix_paths):
+        if install_vsix(batch, code):
+            continue
+        if len(batch) > 1:
+            failed.extend(vsix_path for vsix_path in batch if not install_vsix([vsix_path], code))
+        else:
+            failed.extend(batch)
+    return failed
+
+
+def fetch_file(url, name, session):
+    """
+    return the content of a file of the mirror
+    """
+    scheme, netloc, path, _, _ = urllib.parse.urlsplit(url, scheme="file")
+    if scheme == "file":
+        return (pathlib.Path(path) / name).read_bytes()
+    uri = urllib.parse.urlunsplit((scheme, netloc, path.rstrip("/") + "/" + urllib.parse.quote(name), None, None))
+    r = session.get(uri)
+    r.raise_for_status()
+    return r.content
+
+
+def file_sha256(path):
+    h = hashlib.sha256()
+    with path.open("rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def write_json(path, data):
+    tmp = path.with_name(path.name + ".tmp")
+    tmp.write_text(json.dumps(data))
+    os.replace(str(tmp), str(path))
+
+
+def copy_install(url, extension, jobs, session):
+    """
+    install an extension by copying its extracted tree from the mirror, then
+    register it into extensions.json: the previous version is marked as
+    obsolete, Code removes it at the next start
+    the files that have not changed since the installed version are copied locally
+    return True if the extension has been installed
+    """
+
+    manifest = load_resource(url, extension["tree"] + ".json")
+    if manifest is None:
+        return False
+
+    registry_file = extensions_dir / "extensions.json"
+    registry = json.loads(registry_file.read_text())
+    directory = manifest["directory"]
+    old_dirs = [e["relativeLocation"] for e in registry if e["identifier"]["id"].lower() == manifest["id"]]
+    target = extensions_dir / directory
+
+    if directory in old_dirs and target.is_dir():
+        return True
+
+    tmp = extensions_dir / ("." + directory + ".tmp")
+    shutil.rmtree(str(tmp), ignore_errors=True)
+
+    def copy_file(item):
+        name, (size, sha256) = item
+        dest = tmp / name
+        dest.parent.mkdir(parents=True, exist_ok=True)
+        for d in old_dirs:
+            src = extensions_dir / d / name
+            if src.is_file() and src.stat().st_size == size and file_sha256(src) == sha256:
+                shutil.copyfile(str(src), str(dest))
+                return 0
+        content = fetch_file(url, extension["tree"] + "/" + name, session)
+        if hashlib.sha256(content).hexdigest() != sha256:
+            raise ValueError("checksum mismatch for {}".format(name))
+        dest.write_bytes(content)
+        return size
+
+    try:
+        with ThreadPoolExecutor(max_workers=max(jobs, 1)) as pool:
+            downloaded = sum(pool.map(copy_file, sorted(manifest["files"].items())))
+        if target.exists():
+            shutil.rmtree(str(target))
+        os.rename(str(tmp), str(target))
+    except (OSError, ValueError, requests.RequestException) as e:
+        print("cannot copy {}: {}{}{}".format(directory, COLOR_RED, e, COLOR_END))
+        shutil.rmtree(str(tmp), ignore_errors=True)
+        return False
+
+    registry = [e for e in registry if e["identifier"]["id"].lower() != manifest["id"]]
+    registry.append(
+        {
+            "identifier": {"id": manifest["id"]},
+            "version": manifest["version"],
+            "location": {"$mid": 1, "fsPath": str(target), "path": target.as_posix(), "scheme": "file"},
+            "relativeLocation": directory,
+            "metadata": {
+                "installedTimestamp": int(time.time() * 1000),
+                "source": "vsix",
+                "targetPlatform": manifest["targetPlatform"] or "undefined",
+            },
+        }
+    )
+    write_json(registry_file, registry)
+
+    obsolete_dirs = [d for d in old_dirs if d != directory]
+    if obsolete_dirs:
+        obsolete_file = extensions_dir / ".obsolete"
+        try:
+            obsolete = json.loads(obsolete_file.read_text())
+        except (OSError, ValueError):
+            obsolete = {}
+        obsolete.update((d, True) for d in obsolete_dirs)
+        write_json(obsolete_file, obsolete)
+
+    print(
+        "copied: {} ({} files, {} KiB downloaded) {}".format(
+            COLOR_LIGHT_CYAN + directory + COLOR_END, len(manifest["files"]), downloaded // 1024, CHECK_MARK
+        )
+    )
+    return True
+
+
+def install_extensions_list(url, extensions, dry_run, jobs):
+    """
+    install extensions: they are downloaded concurrently, and the downloaded
+    ones are installed by batches while the other ones are still downloading
+    the extensions extracted by the mirror are copied, if possible
+    return the extensions that have not been installed
+    """
+
+    if extensions_dir is not None and (extensions_dir / "extensions.json").is_file():
+        trees = [e for e in extensions if e.get("tree")]
+        extensions = [e for e in extensions if not e.get("tree")]
+        if dry_run:
+            for e in trees:
+                print(COLOR_GREEN + "copy {}/ {}".format(e["tree"], extensions_dir) + COLOR_END)
+        else:
+            session = requests.Session()
+            for e in trees:
+                if not copy_install(url, e, jobs, session):
+                    extensions.append(e)
+
+    if dry_run:
+        for batch in install_batches(pathlib.Path(e["vsix"]).name for e in extensions):
+            print(COLOR_GREEN + install_command(batch) + COLOR_END)
+        return []
+
+    failed = []
+    with ThreadPoolExecutor(max_workers=max(jobs, 1)) as pool:
+        downloads = {pool.submit(download_vsix, url, e["vsix"], e.get("sha256")): e for e in extensions}
+        pending = set(downloads)
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            downloaded = {}
+            for f in done:
+                if f.result():
+                    downloaded[str(f.result())] = downloads[f]
+                else:
+                    failed.append(downloads[f])
+            failed.extend(downloaded[vsix_path] for vsix_path in install_vsix_batches(list(downloaded)))
+    return failed
+
+
+def read_extensions_dir(path):
+    """
+    return the id@version of the extensions installed into a directory, from
+    its manifest (extensions.json) or from the manifests of the extensions
+    return None if the layout is not recognized
+    """
+
+    try:
+        obsolete = set(json.loads((path / ".obsolete").read_text()))
+    except (OSError, ValueError):
+        obsolete = set()
+
+    installed = set()
 
+    try:
+        for e in json.loads((path / "extensions.json").read_text()):
+            if e.get("relativeLocation") in obsolete:
+                continue
+            installed.add(e["identifier"]["id"] + "@" + e["version"])
+        return installed
+    except OSError:
+        pass
+    except (ValueError, KeyError, TypeError) as e:
+        logging.debug("unexpected extensions.json in %s: %r", path, e)
+        return None
+
+    # older versions of Code: no manifest
+    for d in path.iterdir():
+        if d.name in obsolete or d.name.startswith("."):
+            continue
+        try:
+            manifest = json.loads((d / "package.json").read_text(encoding="utf-8"))
+            installed.add("{}.{}@{}".format(manifest["publisher"], manifest["name"], manifest["version"]))
+        except NotADirectoryError:
+            continue
+        except (OSError, ValueError, KeyError) as e:
+            logging.debug("unexpected extension %s: %r", d, e)
+            return None
+    return installed
 
-def update_extensions(url, dry_run, platform, data):
+
+def get_installed_extensions():
+    """
+    return the id@version of the installed extensions
+    the extensions directories are read directly, code is run only if their layout is unknown
+    """
+
+    installed = set()
+    found = False
+    for path in EXTENSIONS_DIRS:
+        path = pathlib.Path(path).expanduser()
+        if not path.is_dir():
+            continue
+        extensions = read_extensions_dir(path)
+        if extensions is None:
+            found = False
+            break
+        installed.update(extensions)
+        found = True
+
+    if not found:
+        logging.debug("running code --list-extensions")
+        s = subprocess.check_output("code --list-extensions --show-versions", shell=True)
+        installed = set(s.decode().split())
+
+    return sorted(installed)
+
+
+def update_extensions(url, dry_run, platform, data, jobs=4, changed=None):
     """
     update installed extensions
+    the outdated extensions are downloaded concurrently, then installed
+    if `changed` is given, only these extensions are compared with the catalog
+    return the keys (in lowercase) of the installed extensions and of the ones
+    that have not been updated, or None if nothing has been updated
     """
 
     processed = set()
 
     if os.getuid() == 0:
         print("error: cannot update extensions as root")
-        return processed
+        return processed, None
 
     # get extension database
     extensions = data["extensions"]
@@ -282,20 +906,27 @@ def update_extensions(url, dry_run, platform, data):
 
     # get installed extensions
     print("\033[95mFetching installed extensions...\033[0m")
-    s = subprocess.check_output("code --list-extensions --show-versions", shell=True)
-    installed = sorted(set(s.decode().split()))
+    installed = get_installed_extensions()
 
     defer = []
+    outdated = []
+    outdated_keys = {}
+    unchanged = 0
 
-    # do update
+    # find the outdated extensions
     for i in installed:
         try:
             key, version = i.split("@", 1)
 
-            if key == "ms-vscode.cpptools" and platform is not None:
+            if key.lower() == "ms-vscode.cpptools" and platform is not None:
                 key = "ms-vscode.cpptools-" + platform
 
-            processed.add(key)
+            # the identifiers of the extensions are case insensitive
+            processed.add(key.lower())
+
+            if changed is not None and key.lower() not in changed:
+                unchanged += 1
+                continue
 
             colorized_key = COLOR_LIGHT_CYAN + key + COLOR_END
 
@@ -309,38 +940,37 @@ def update_extensions(url, dry_run, platform, data):
                 print("extension up to date: {} ({}) {}".format(colorized_key, version, CHECK_MARK))
 
             else:
-                vsix = extension["vsix"]
                 print(
                     "updating: {} from version {} to version {} {}".format(
                         colorized_key, version, extension["version"], HOT_BEVERAGE
                     )
                 )
-                install_extension(url, vsix, dry_run)
+                outdated.append(extension)
+                outdated_keys[extension["vsix"]] = key.lower()
 
-            if key == "golang.Go":
-                defer.append(lambda: update_go_tools(url, dry_run, data["go-tools"]))
+            if key.lower() == "golang.go":
+                defer.append(lambda: update_go_tools(url, dry_run, data["go-tools"], data.get("go-proxy"), jobs))
 
         except Exception as e:
             logging.error("error for {}: {}{}{}".format(i, COLOR_RED, e, COLOR_END))
 
+    if unchanged:
+        print("{} extension(s) unchanged since the last update {}".format(unchanged, CHECK_MARK))
+
+    # do update
+    failed = install_extensions_list(url, outdated, dry_run, jobs)
+
     for action in defer:
         action()
 
-    return processed
+    return processed, set(outdated_keys[e["vsix"]] for e in failed)
 
 
-def install_extensions(url, dry_run, platform, extensions_list, data):
+def select_extensions(extensions_list, extensions, platform):
     """
+    yield the keys of the catalog for a list of extensions
     """
 
-    if os.getuid() == 0:
-        print("error: cannot install extensions as root")
-        return
-
-    extensions = data["extensions"]
-
-    defer = []
-
     for key in extensions_list:
         if key not in extensions:
             if key + "-" + platform in extensions:
@@ -348,20 +978,123 @@ def install_extensions(url, dry_run, platform, extensions_list, data):
             else:
                 print("error: extension not found {}".format(key))
                 continue
-        vsix = extensions[key]["vsix"]
         version = extensions[key]["version"]
         colorized_key = COLOR_LIGHT_CYAN + key + COLOR_END
         print("installing: {} version {} {}".format(colorized_key, version, HOT_BEVERAGE))
-        install_extension(url, vsix, dry_run)
+        yield key
+
+
+def install_extensions(url, dry_run, platform, extensions_list, data, jobs=4):
+    """
+    install extensions from the mirror
+    """
+
+    if os.getuid() == 0:
+        print("error: cannot install extensions as root")
+        return
+
+    extensions = data["extensions"]
+
+    defer = []
+    selected = []
+
+    for key in select_extensions(extensions_list, extensions, platform):
+        selected.append(extensions[key])
 
         if key == "golang.Go":
-            defer.append(lambda: update_go_tools(url, dry_run, data["go-tools"]))
+            defer.append(lambda: update_go_tools(url, dry_run, data["go-tools"], data.get("go-proxy"), jobs))
+
+    install_extensions_list(url, selected, dry_run, jobs)
 
     for action in defer:
         action()
 
 
-def update_tool(url, data):
+def extract_server(archive, server_dir):
+    """
+    extract the tarball of a remote server, without its top directory
+    """
+
+    import tarfile
+
+    with tarfile.open(str(archive)) as tar:
+        members = []
+        for member in tar.getmembers():
+            parts = pathlib.PurePosixPath(member.name).parts[1:]
+            if not parts or ".." in parts:
+                continue
+            member.name = "/".join(parts)
+            members.append(member)
+        tar.extractall(str(server_dir), members)
+
+
+def server_cli(server_dir):
+    """
+    return the command line interface of a remote server
+    """
+    for name in ("bin/code-server", "server.sh"):
+        if (server_dir / name).exists():
+            return (server_dir / name).as_posix()
+    return None
+
+
+def server_install_command(cli, server_dir):
+    """
+    return the command that installs extensions into the extensions directory of a remote server
+    """
+    extensions_dir = server_dir.parent.parent / "extensions"
+    return "{} --extensions-dir {}".format(shlex.quote(cli), shlex.quote(extensions_dir.as_posix()))
+
+
+def provision_servers(url, dry_run, platform, extensions_list, data, commit, arch, server_dirs, jobs=4):
+    """
+    install a remote server and extensions into .vscode-server directories,
+    for instance when building container images
+    the server and the extensions are downloaded once for all the directories
+    """
+
+    print("\033[95mProvisioning Visual Studio Code server {}...\033[0m".format(commit))
+
+    extensions = data["extensions"]
+    selected = [extensions[key] for key in select_extensions(extensions_list, extensions, platform)]
+
+    server_dirs = [pathlib.Path(d).expanduser() / "bin" / commit for d in server_dirs]
+    missing = [d for d in server_dirs if server_cli(d) is None]
+    tarball = "code/{}/vscode-server-linux-{}.tar.gz".format(commit, arch)
+
+    if dry_run:
+        for server_dir in missing:
+            print_cmd(["extract", tarball, server_dir.as_posix()])
+        for server_dir in server_dirs:
+            cli = server_cli(server_dir) or (server_dir / "bin/code-server").as_posix()
+            code = server_install_command(cli, server_dir)
+            for batch in install_batches(pathlib.Path(e["vsix"]).name for e in selected):
+                print(COLOR_GREEN + install_command(batch, code) + COLOR_END)
+        return
+
+    with ThreadPoolExecutor(max_workers=max(jobs, 1)) as pool:
+        server = pool.submit(download_vsix, url, tarball) if missing else None
+        vsixes = list(pool.map(lambda e: download_vsix(url, e["vsix"], e.get("sha256")), selected))
+        archive = server.result() if server else None
+
+    if missing and not archive:
+        print("error: no server {} for {} {}".format(commit, arch, HEAVY_BALLOT_X))
+        return
+
+    for server_dir in server_dirs:
+        if server_dir in missing:
+            print("installing: {} {}".format(COLOR_LIGHT_CYAN + server_dir.as_posix() + COLOR_END, HOT_BEVERAGE))
+            server_dir.mkdir(parents=True, exist_ok=True)
+            extract_server(archive, server_dir)
+
+        cli = server_cli(server_dir)
+        if cli is None:
+            print("error: unknown layout of {} {}".format(server_dir, HEAVY_BALLOT_X))
+            continue
+        install_vsix_batches([v for v in vsixes if v], server_install_command(cli, server_dir))
+
+
+def update_tool(url, data, cache_dir):
     """ update local tool """
 
     print("\033[95mInstalling or updating companion tool...\033[0m")
@@ -369,11 +1102,27 @@ def update_tool(url, data):
     logging.debug("DEFAULT_URL %s", DEFAULT_URL)
     logging.debug("LOCAL_MODE %s", LOCAL_MODE)
 
+    local_path = pathlib.Path("~/.local/bin/code-tool").expanduser()
+
+    # the version descriptor is small and most often not modified
+    descriptor = load_cached(url, "get.json", cache_dir, quiet=True)
+    if descriptor is not None:
+        if LOCAL_MODE and descriptor["version"] == TOOL_VERSION:
+            return
+        if not LOCAL_MODE and local_path.exists():
+            local_version = re.search(rb"TOOL_VERSION = (\d+)", local_path.read_bytes())
+            if local_version and int(local_version.group(1)) == TOOL_VERSION:
+                return
+
     # get the remote version and source code
     remote_code = load_resource(url, "get.py", raw=True)
     if remote_code is None:
         return
 
+    if descriptor is not None and hashlib.sha256(remote_code).hexdigest() != descriptor["sha256"]:
+        print("cannot update code-tool: {}checksum mismatch{}".format(COLOR_RED, COLOR_END))
+        return
+
     remote_code = remote_code.replace(b'\nDEFAULT_URL = "."', b'\nDEFAULT_URL = "%s"' % (url.encode()), 1)
     remote_code = remote_code.replace(b"\nLOCAL_MODE = False", b"\nLOCAL_MODE = True", 1)
 
@@ -383,8 +1132,6 @@ def update_tool(url, data):
         return
     remote_version = int(remote_version.group(1))
 
-    local_path = pathlib.Path("~/.local/bin/code-tool").expanduser()
-
     if LOCAL_MODE:
         if remote_version == TOOL_VERSION:
             # local tool is up to date
@@ -416,55 +1163,134 @@ def update_tool(url, data):
         exit()
 
 
-def list_extensions(url, data, verbose):
+class SearchWords(dict):
+    """
+    translation table that replaces the characters that are not in SEARCH_WORD_CHARS with spaces
+    """
+
+    def __missing__(self, char):
+        self[char] = char if chr(char) in SEARCH_WORD_CHARS else " "
+        return self[char]
+
+
+def search_extensions(extensions, query):
+    """
+    return the keys of the extensions matching a query, best matches first
+    an extension matches if the query is a substring of its key or name, or
+    if each word of the query starts a word of its key, name, description or author
+    """
+
+    query = query.strip().lower()
+    keys = sorted(extensions.keys(), key=str.lower)
+    if not query:
+        return keys
+
+    # the texts of all extensions are lowered and split into words at once, the
+    # key and the name apart from the description and the author
+    values = [extensions[key] for key in keys]
+    heads = "\x01 ".join(key + " " + (e.get("name") or "") for key, e in zip(keys, values)).lower()
+    tails = "\x01 ".join((e.get("description") or "") + " " + (e.get("author") or "") for e in values).lower()
+    table = SearchWords({1: 1})
+    names = heads.split("\x01 ")
+    # a space before each word: a word of the query must start a word
+    head_words = (" " + heads.translate(table)).split("\x01")
+    tail_words = (" " + tails.translate(table)).split("\x01")
+
+    # 1 + the points of the words of the query, 0 if one of them is missing
+    scores = [1] * len(keys)
+    for word in re.findall(r"[a-z0-9]+", query):
+        word = " " + word
+        # a word of the key or the name is worth more
+        scores = [
+            (score + 10 if word in head else score + 3 if word in tail else 0) if score else 0
+            for score, head, tail in zip(scores, head_words, tail_words)
+        ]
+
+    found = {i: score - 1 for i, score in enumerate(scores) if score > 1}
+
+    # the query itself in the key or the name
+    for i in [i for i, name in enumerate(names) if query in name]:
+        key = keys[i].lower()
+        name = (values[i].get("name") or "").lower()
+        if query == key or query == name:
+            points = 100
+        elif key.startswith(query) or name.startswith(query):
+            points = 50
+        elif query in key or query in name:
+            points = 30
+        else:
+            continue
+        found[i] = found.get(i, 0) + points
+
+    return [keys[i] for _, i in sorted((-points, i) for i, points in found.items())]
+
+
+def list_extensions(url, data, verbose, query="", page=1, page_size=0, as_json=False):
     """ list available extensions """
 
-    try:
-        cols = int(subprocess.check_output(["tput", "cols"]))
-    except Exception:
-        cols = 100
+    extensions = data["extensions"]
+    keys = search_extensions(extensions, query)
+    total = len(keys)
+    if page_size > 0:
+        keys = keys[(page - 1) * page_size:page * page_size]
+
+    if as_json:
+        results = []
+        for key in keys:
+            extension = extensions[key]
+            results.append(
+                {
+                    "key": key,
+                    "name": extension.get("name"),
+                    "version": extension.get("version"),
+                    "description": extension.get("description"),
+                    "author": extension.get("author"),
+                }
+            )
+        print(json.dumps({"query": query, "total": total, "page": page, "extensions": results}, indent=2))
+        return
+
+    cols = shutil.get_terminal_size((100, 24)).columns
 
-    print("List of available extensions")
+    if query:
+        print("Extensions matching '{}': {}".format(query, total))
+    else:
+        print("List of available extensions")
     print()
 
     if cols < 200:
-        color = ["\033[94m", "\033[33m"]
-        for extension in sorted(data["extensions"].keys()):
-            description = data["extensions"][extension]["description"]
+        for extension in keys:
+            description = extensions[extension]["description"]
             print("    \033[92m" + extension + "\033[0m")
             for c2 in textwrap.wrap(
                 description, initial_indent="        ", subsequent_indent="        ", width=cols - 10
             ):
                 print(c2)
 
-    elif False:
-        w1 = max(len(extension) for extension in data["extensions"].keys())
-        w2 = max(len(v["version"]) for v in data["extensions"].values())
-        fmt = ("{:%d} | {:>%d} | " % (w1, w2)).format
-        n = 0
-        color = ["\033[97m", "\033[94m"]
-        for extension, desc in data["extensions"].items():
-            n += 1
-            c1 = fmt(extension, desc["version"])
-            for c2 in textwrap.wrap(desc["description"], width=cols - w1 - w2 - 8):
-                print(color[n % 2] + c1 + c2 + "\033[0m")
-                c1 = fmt("", "")
-    else:
-        w1 = max(len(extension) for extension in data["extensions"].keys())
+    elif keys:
+        w1 = max(len(extension) for extension in keys)
         fmt = ("{:%d} | " % (w1)).format
 
         print(fmt("Tag") + "Description")
         print(fmt("-" * w1) + "-" * 50)
         n = 0
         color = ["\033[97m", "\033[94m"]
-        for extension in sorted(data["extensions"].keys()):
-            description = data["extensions"][extension]["description"]
+        for extension in keys:
+            description = extensions[extension]["description"]
             n += 1
             c1 = fmt(extension)
             for c2 in textwrap.wrap(description, width=cols - w1 - 4):
                 print(color[n % 2] + c1 + c2 + "\033[0m")
                 c1 = fmt("")
 
+    if page_size > 0 and page * page_size < total:
+        print()
+        print(
+            "page {} of {}, next one with --page {}, all of them with --all".format(
+                page, (total + page_size - 1) // page_size, page + 1
+            )
+        )
+
 
 def main():
     """ main function """
@@ -489,11 +1315,78 @@ def main():
     parser.add_argument("-F", "--favorites", help="install favorite extensions", action="store_true")
     parser.add_argument("-t", "--team", help="name of extension list")
     parser.add_argument("-i", "--install-extension", help="install extension", action="append")
-    parser.add_argument("-l", "--list-extensions", help="list available extensions", action="store_true")
+    parser.add_argument(
+        "-l",
+        "--list-extensions",
+        help="list available extensions, or the ones matching a query",
+        nargs="?",
+        const="",
+        metavar="QUERY",
+    )
+    parser.add_argument("--page", help="page of the list of extensions", type=int, default=1)
+    parser.add_argument(
+        "--page-size",
+        help="number of extensions by page (default: {} for a search, otherwise 0, no paging)".format(SEARCH_PAGE_SIZE),
+        type=int,
+    )
+    parser.add_argument("--all", help="list all the extensions matching a query", action="store_true")
+    parser.add_argument("--json", help="list the extensions as JSON", action="store_true")
+    parser.add_argument("-j", "--jobs", help="number of concurrent downloads (default: 4)", type=int, default=4)
+    parser.add_argument(
+        "--cache-dir",
+        help="download cache (default: $CODE_TOOL_CACHE or ~/.cache/code-tool)",
+        default=os.environ.get("CODE_TOOL_CACHE") or os.path.expanduser("~/.cache/code-tool"),
+    )
+    parser.add_argument(
+        "--cache-size",
+        help="maximum size of the download cache in MiB, 0 to disable (default: {})".format(CACHE_SIZE),
+        type=int,
+        default=CACHE_SIZE,
+    )
+    parser.add_argument(
+        "--cli-install", help="install the extensions with code, even if they can be copied", action="store_true"
+    )
+    parser.add_argument(
+        "--full", help="compare all installed extensions, not only the changed ones", action="store_true"
+    )
+    parser.add_argument(
+        "-o", "--offline", help="use the cached data, without contacting the mirror", action="store_true"
+    )
+    parser.add_argument(
+        "--server-commit", help="install the remote server of a Code commit (or latest) and the extensions"
+    )
+    parser.add_argument(
+        "--server-dir",
+        help="target directory of the remote server (default: ~/.vscode-server), may be repeated",
+        action="append",
+    )
+    parser.add_argument(
+        "--server-arch",
+        help="architecture of the remote server (default: x64)",
+        choices=["x64", "armhf", "arm64", "alpine"],
+        default="x64",
+    )
     parser.add_argument("url", help="mirror url", nargs="?", default=DEFAULT_URL)
     parser.add_argument("--mirror-url", action="store_true", help=argparse.SUPPRESS, dest="mirror_url")
 
-    args = parser.parse_args()
+    # code-tool search <query>: same as -l <query>
+    argv = sys.argv[1:]
+    if argv[:1] == ["search"]:
+        argv[0] = "--list-extensions"
+
+    args = parser.parse_args(argv)
+
+    # code-tool -l <url>: the url is not a query
+    if (
+        args.list_extensions
+        and args.url == DEFAULT_URL
+        and (re.match(r"\w+://", args.list_extensions) or os.path.exists(args.list_extensions))
+    ):
+        args.url, args.list_extensions = args.list_extensions, ""
+
+    # the best matches of a search, unless all of them are asked for
+    if args.page_size is None:
+        args.page_size = SEARCH_PAGE_SIZE if args.list_extensions and not (args.all or args.json) else 0
 
     # hidden option to get the mirror URL
     if args.mirror_url:
@@ -518,6 +1411,14 @@ def main():
     if args.url == ".":
         args.url = pathlib.Path(".").absolute().as_posix()
 
+    if args.cache_size > 0:
+        global cache
+        cache = Cache(args.cache_dir, args.cache_size * 1024 * 1024)
+
+    if not args.cli_install:
+        global extensions_dir
+        extensions_dir = pathlib.Path(EXTENSIONS_DIRS[0]).expanduser()
+
     if args.verbose:
         logging.basicConfig(format="%(asctime)s:%(levelname)s:%(message)s", level=logging.DEBUG, datefmt="%H:%M:%S")
         logging.debug("args {}".format(args))
@@ -527,7 +1428,7 @@ def main():
         print("Mode: {}".format(["remote", "remote"][LOCAL_MODE]))
         print("URL: {}".format(DEFAULT_URL))
 
-        data = load_resource(args.url, "data.json")
+        data, _ = load_data(args.url, args.cache_dir, args.offline)
         if data:
             print()
             print("code: {} {} {}".format(data["code"]["version"], data["code"]["channel"], data["code"]["commit_id"]))
@@ -535,18 +1436,43 @@ def main():
 
         exit()
 
-    data = load_resource(args.url, "data.json")
+    data, changes = load_data(args.url, args.cache_dir, args.offline)
     if not data:
         logging.error("Cannot retrieve data")
         exit(2)
 
-    # install update tool
-    update_tool(args.url, data)
+    if args.list_extensions is not None:
+        list_extensions(
+            args.url, data, args.verbose, args.list_extensions, max(args.page, 1), args.page_size, args.json
+        )
+        exit()
 
-    if args.list_extensions:
-        list_extensions(args.url, data, args.verbose)
+    # provision remote servers, not the local installation
+    if args.server_commit:
+        if args.server_commit == "latest":
+            args.server_commit = data["code"]["commit_id"]
+        extensions = set(args.install_extension or [])
+        if args.favorites or args.team:
+            team = load_resource(args.url, (args.team or "team") + ".json")
+            if team:
+                extensions = extensions.union(set(team))
+        provision_servers(
+            args.url,
+            args.dry_run,
+            args.platform,
+            sorted(extensions),
+            data,
+            args.server_commit,
+            args.server_arch,
+            args.server_dir or ["~/.vscode-server"],
+            args.jobs,
+        )
         exit()
 
+    # install update tool
+    if not args.offline:
+        update_tool(args.url, data, args.cache_dir)
+
     if args.update:
         args.code = True
         args.extensions = True
@@ -564,7 +1490,13 @@ def main():
 
     # update extensions
     if args.extensions:
-        processed = update_extensions(args.url, args.dry_run, args.platform, data)
+        changed = None
+        if not args.full:
+            changed = changed_extensions(args.url, args.cache_dir, changes)
+        processed, failed = update_extensions(args.url, args.dry_run, args.platform, data, args.jobs, changed)
+        if not args.dry_run and failed is not None and "generation" in data:
+            # the extensions that have failed are compared again next time
+            write_applied_generation(args.url, args.cache_dir, data["generation"], failed)
     else:
         processed = set()
 
@@ -581,9 +1513,9 @@ def main():
             if team:
                 extensions = extensions.union(set(team))
 
-        extensions = extensions - processed
+        extensions = set(key for key in extensions if key.lower() not in processed)
 
-        install_extensions(args.url, args.dry_run, args.platform, extensions, data)
+        install_extensions(args.url, args.dry_run, args.platform, extensions, data, args.jobs)
 
 
 if __name__ == "__main__":
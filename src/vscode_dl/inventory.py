@@ -0,0 +1,150 @@
+"""
+inventory of the artifacts of the mirror
+"""
+
+import hashlib
+import json
+import pathlib
+
+try:
+    from .storage import LocalStorage
+except ImportError:
+    # run directly from source
+    from storage import LocalStorage
+
+# directories of the web root that contain artifacts
+ARTIFACT_DIRS = ["code", "vsix", "icons", "tree", "goproxy"]
+
+INVENTORY_FILE = "inventory.json"
+
+
+class Inventory:
+    """
+    size and modification time of every artifact, by path relative to the web root
+    every change of the mirror is stamped with the generation that publishes it
+    """
+
+    def __init__(self, root, storage=None):
+        self.root = pathlib.Path(root)
+        self.storage = storage if storage is not None else LocalStorage(root)
+        self.files = {}
+        # removed artifacts, with the generation of their removal
+        self.deleted = {}
+        # last published generation
+        self.generation = 0
+
+    def __contains__(self, path):
+        return str(path) in self.files
+
+    def __len__(self):
+        return len(self.files)
+
+    def get(self, path):
+        return self.files.get(str(path))
+
+    def stat(self, path):
+        """
+        add or refresh one artifact
+        return its entry, or None if the file does not exist
+        """
+        path = str(path)
+        st = self.storage.stat(path)
+        if st is None:
+            self.remove(path)
+            return None
+
+        entry = self.files.get(path)
+        if (
+            entry is None
+            or entry["size"] != st["size"]
+            or entry["mtime"] != int(st["mtime"])
+        ):
+            # the file has changed: forget everything we knew about it
+            entry = {
+                "size": st["size"],
+                "mtime": int(st["mtime"]),
+                "generation": self.generation + 1,
+            }
+            self.files[path] = entry
+            self.deleted.pop(path, None)
+        return entry
+
+    def checksum(self, path):
+        """
+        return the SHA-256 of an artifact, computed once
+        """
+        entry = self.stat(path)
+        if entry is None:
+            return None
+        if "sha256" not in entry:
+            h = hashlib.sha256()
+            with self.storage.open_read(path) as f:
+                for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                    h.update(chunk)
+            entry["sha256"] = h.hexdigest()
+        return entry["sha256"]
+
+    def remove(self, path):
+        path = str(path)
+        if self.files.pop(path, None) is not None:
+            self.deleted[path] = self.generation + 1
+
+    def publish(self):
+        """
+        close the current generation: the next changes belong to the next one
+        """
+        self.generation += 1
+        return self.generation
+
+    def changes(self, since):
+        """
+        return the artifacts added or modified, and the ones removed, after
+        the generation `since`
+        """
+        added = [
+            path
+            for path, entry in self.files.items()
+            if entry.get("generation", 0) > since
+        ]
+        removed = [path for path, gen in self.deleted.items() if gen > since]
+        return sorted(added), sorted(removed)
+
+    def scan(self):
+        """
+        walk the artifact directories
+        """
+        seen = set()
+        for d in ARTIFACT_DIRS:
+            for path in self.storage.list(d):
+                self.stat(path)
+                seen.add(path)
+        for path in set(self.files) - seen:
+            self.remove(path)
+
+    def load(self):
+        """
+        read the inventory file written by the previous run
+        """
+        try:
+            data = json.loads(self.storage.read_bytes(INVENTORY_FILE))
+            self.files = data["files"]
+        except (OSError, ValueError, KeyError):
+            self.files = {}
+            data = {}
+        self.deleted = data.get("deleted", {})
+        self.generation = data.get("generation", 0)
+
+    def save(self):
+        """
+        write the inventory file
+        """
+        data = json.dumps(
+            {
+                "generation": self.generation,
+                "files": self.files,
+                "deleted": self.deleted,
+            },
+            indent=1,
+            sort_keys=True,
+        )
+        self.storage.write_bytes(INVENTORY_FILE, data.encode())
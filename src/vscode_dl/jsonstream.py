@@ -0,0 +1,154 @@
+"""
+incremental reader of large JSON documents, such as the gallery responses
+the document is walked while it is received: only the values that are asked
+for are decoded, the other ones are skipped without being built
+"""
+
+import codecs
+import json
+
+# whitespace allowed between JSON tokens
+WHITESPACE = " \t\n\r"
+
+# characters that may continue a number
+NUMBER_CHARS = "0123456789.eE+-"
+
+
+class Reader:
+    """
+    walk a JSON document read from an iterator of bytes chunks
+    """
+
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.decoder = codecs.getincrementaldecoder("utf-8")()
+        self.decode = json.JSONDecoder().raw_decode
+        self.buf = ""
+        self.pos = 0
+        self.eof = False
+
+    def fill(self):
+        """
+        read the next chunk, dropping the consumed part of the buffer
+        return False at the end of the document
+        """
+        if self.eof:
+            return False
+        chunk = next(self.chunks, None)
+        if chunk is None:
+            self.eof = True
+            text = self.decoder.decode(b"", final=True)
+        else:
+            text = self.decoder.decode(chunk)
+        self.buf = self.buf[self.pos :] + text
+        self.pos = 0
+        return True
+
+    def peek(self):
+        """
+        return the next significant character, without consuming it
+        """
+        while True:
+            while self.pos < len(self.buf) and self.buf[self.pos] in WHITESPACE:
+                self.pos += 1
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if not self.fill():
+                raise ValueError("unexpected end of JSON document")
+
+    def expect(self, char):
+        if self.peek() != char:
+            raise ValueError(
+                f"expected {char!r} at {self.buf[self.pos:self.pos + 20]!r}"
+            )
+        self.pos += 1
+
+    def value(self):
+        """
+        decode the next value
+        """
+        self.peek()
+        while True:
+            try:
+                value, end = self.decode(self.buf, self.pos)
+            except ValueError:
+                # incomplete value: read more
+                if not self.fill():
+                    raise
+                continue
+            # a number may continue in the next chunk
+            if not self.buf[end:].strip(NUMBER_CHARS) and self.fill():
+                continue
+            self.pos = end
+            return value
+
+    def iter_object(self):
+        """
+        yield the keys of the next object
+        the caller has to consume the value of each key
+        """
+        self.expect("{")
+        if self.peek() == "}":
+            self.pos += 1
+            return
+        while True:
+            key = self.value()
+            self.expect(":")
+            yield key
+            if self.peek() == ",":
+                self.pos += 1
+            else:
+                self.expect("}")
+                return
+
+    def iter_array(self):
+        """
+        yield once for each item of the next array
+        the caller has to consume the item
+        """
+        self.expect("[")
+        if self.peek() == "]":
+            self.pos += 1
+            return
+        while True:
+            yield
+            if self.peek() == ",":
+                self.pos += 1
+            else:
+                self.expect("]")
+                return
+
+    def skip(self):
+        """
+        consume the next value without building it
+        """
+        c = self.peek()
+        if c == "{":
+            for _ in self.iter_object():
+                self.skip()
+        elif c == "[":
+            for _ in self.iter_array():
+                self.skip()
+        else:
+            self.value()
+
+    def iter_path(self, path):
+        """
+        follow the object keys of `path`, arrays being traversed, and yield
+        once positioned on each value found
+        the caller has to consume the value
+        """
+        c = self.peek()
+        if c == "[":
+            for _ in self.iter_array():
+                yield from self.iter_path(path)
+        elif not path:
+            yield
+        elif c == "{":
+            for key in self.iter_object():
+                if key == path[0]:
+                    yield from self.iter_path(path[1:])
+                else:
+                    self.skip()
+        else:
+            self.skip()
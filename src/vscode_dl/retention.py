@@ -0,0 +1,105 @@
+"""
+retention policy of the old versions of the mirror
+"""
+
+import datetime
+import logging
+import re
+import urllib.parse
+from collections import defaultdict
+from operator import itemgetter
+
+# date and request of the common/combined log formats (nginx, Apache)
+# and of the Python http.server log
+LOG_LINE = re.compile(r'\[([^\]]+)\] "(?:GET|HEAD) ([^ "]+)[^"]*" (\d{3})')
+LOG_DATE_FORMATS = ["%d/%b/%Y:%H:%M:%S %z", "%d/%b/%Y %H:%M:%S"]
+
+# path of an artifact in a request, the mirror may be served below a prefix
+ARTIFACT_PATH = re.compile(r"(?:^|/)((?:code|vsix|icons)/.+)$")
+
+
+def parse_log_date(text):
+    for fmt in LOG_DATE_FORMATS:
+        try:
+            return datetime.datetime.strptime(text, fmt).timestamp()
+        except ValueError:
+            pass
+
+
+def read_access_log(path):
+    """
+    return the last successful access time of each artifact of a web server log
+    """
+
+    if str(path).endswith(".gz"):
+        import gzip
+
+        f = gzip.open(path, "rt", errors="replace")
+    else:
+        f = open(path, errors="replace")
+
+    accessed = {}
+    with f:
+        for line in f:
+            m = LOG_LINE.search(line)
+            if m is None or m.group(3)[0] not in "23":
+                continue
+            url = urllib.parse.unquote(urllib.parse.urlsplit(m.group(2)).path)
+            name = ARTIFACT_PATH.search(url)
+            timestamp = parse_log_date(m.group(1))
+            if name is None or timestamp is None:
+                continue
+            name = name.group(1)
+            if timestamp > accessed.get(name, 0):
+                accessed[name] = timestamp
+    return accessed
+
+
+def select(artifacts, keep=0, quota=None, total=0, recent=None, now=None):
+    """
+    choose the artifacts to evict
+
+    `artifacts` are dicts with: name, key, version (list of ints), size,
+    accessed (timestamp or None), current (listed in the catalog) and
+    team (listed in team.json)
+
+    the newest version of each key, the `keep` next ones, the versions of the
+    catalog and the ones accessed within `recent` seconds are never evicted
+    without quota, all the other versions are evicted, otherwise the least
+    valuable ones are evicted until the `total` size fits into the quota
+    """
+
+    by_key = defaultdict(list)
+    for artifact in artifacts:
+        by_key[artifact["key"]].append(artifact)
+
+    candidates = []
+    for versions in by_key.values():
+        versions.sort(key=itemgetter("version"), reverse=True)
+        for rank, artifact in enumerate(versions):
+            if rank <= max(keep, 0) or artifact["current"]:
+                continue
+            accessed = artifact["accessed"]
+            if recent is not None and accessed and accessed >= now - recent:
+                continue
+            candidates.append((rank, artifact))
+
+    if quota is None:
+        return [artifact for _, artifact in candidates]
+
+    # least valuable first: not wanted by the team, not downloaded for the
+    # longest time, the oldest versions
+    candidates.sort(key=lambda c: (c[1]["team"], c[1]["accessed"] or 0, -c[0]))
+
+    evicted = []
+    for _, artifact in candidates:
+        if total <= quota:
+            break
+        evicted.append(artifact)
+        total -= artifact["size"]
+
+    if total > quota:
+        logging.warning(
+            "quota exceeded by %d bytes: the remaining versions are kept", total - quota
+        )
+    return evicted
@@ -0,0 +1,368 @@
+"""
+storage backends of the mirror: a local directory or an S3-compatible object store
+"""
+
+import contextlib
+import os
+import pathlib
+import shutil
+import urllib.parse
+
+# size of the parts of the multipart uploads (S3 minimum is 5 MiB)
+PART_SIZE = 8 * 1024 * 1024
+
+
+class LocalStorage:
+    """
+    the web root is a local directory
+    """
+
+    local = True
+
+    def __init__(self, root):
+        self.root = pathlib.Path(root)
+
+    def name(self, path):
+        """
+        return the name of an artifact, relative to the web root
+        """
+        path = pathlib.PurePath(path)
+        if path.is_absolute():
+            try:
+                path = path.relative_to(self.root)
+            except ValueError:
+                pass
+        return path.as_posix()
+
+    def path(self, name):
+        """
+        return the local path of an artifact
+        """
+        return self.root / self.name(name)
+
+    def stat(self, name, metadata=False):
+        """
+        return the size, the modification time and the upstream etag of an
+        artifact, or None if it does not exist
+        `metadata` asks for the upstream modification time and etag, that the
+        conditional downloads need
+        """
+        path = self.path(name)
+        if not path.is_file():
+            return None
+        st = path.stat()
+        return {"size": st.st_size, "mtime": st.st_mtime, "etag": None}
+
+    def exists(self, name):
+        return self.path(name).is_file()
+
+    @contextlib.contextmanager
+    def open_write(self, name, mtime=None, etag=None):
+        """
+        write an artifact: the previous version is replaced atomically once
+        the writing is complete
+        """
+        path = self.path(name)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = path.with_name(path.name + ".part")
+        try:
+            with tmp.open("wb") as f:
+                yield f
+            if mtime is not None:
+                try:
+                    os.utime(tmp, (mtime, mtime))
+                except OSError:
+                    pass
+            os.replace(tmp, path)
+        finally:
+            if tmp.exists():
+                tmp.unlink()
+
+    def write_bytes(self, name, data, mode=None):
+        with self.open_write(name) as f:
+            f.write(data)
+        if mode is not None:
+            self.path(name).chmod(mode)
+
+    def open_read(self, name):
+        return self.path(name).open("rb")
+
+    def read_bytes(self, name):
+        return self.path(name).read_bytes()
+
+    def upload_file(self, local, name, mode=None):
+        """
+        copy a local file into the storage
+        """
+        path = self.path(name)
+        if pathlib.Path(local).resolve() != path.resolve():
+            path.parent.mkdir(parents=True, exist_ok=True)
+            # replace the file instead of rewriting it: it may be hard-linked
+            tmp = path.with_name(path.name + ".part")
+            shutil.copy2(str(local), str(tmp))
+            os.replace(tmp, path)
+        if mode is not None:
+            path.chmod(mode)
+
+    def symlink(self, name, target):
+        path = self.path(name)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        if path.is_symlink():
+            path.unlink()
+        path.symlink_to(target, target_is_directory=True)
+
+    def delete(self, name):
+        path = self.path(name)
+        if path.is_file() or path.is_symlink():
+            path.unlink()
+
+    def list(self, prefix=""):
+        """
+        yield the names of the artifacts below a prefix (symbolic links excluded)
+        """
+        base = self.path(prefix) if prefix else self.root
+        for f in base.glob("**/*"):
+            if f.is_file() and not f.is_symlink():
+                yield f.relative_to(self.root).as_posix()
+
+
+class MultipartWriter:
+    """
+    stream an object into S3: the data is sent by parts while it is written
+    """
+
+    def __init__(self, client, bucket, key, metadata):
+        self.client = client
+        self.bucket = bucket
+        self.key = key
+        self.metadata = metadata
+        self.buffer = bytearray()
+        self.parts = []
+        self.upload_id = None
+
+    def write(self, data):
+        self.buffer += data
+        if len(self.buffer) >= PART_SIZE:
+            self.flush_part()
+        return len(data)
+
+    def flush_part(self):
+        if self.upload_id is None:
+            r = self.client.create_multipart_upload(
+                Bucket=self.bucket, Key=self.key, Metadata=self.metadata
+            )
+            self.upload_id = r["UploadId"]
+        number = len(self.parts) + 1
+        r = self.client.upload_part(
+            Bucket=self.bucket,
+            Key=self.key,
+            UploadId=self.upload_id,
+            PartNumber=number,
+            Body=bytes(self.buffer),
+        )
+        self.parts.append({"ETag": r["ETag"], "PartNumber": number})
+        self.buffer.clear()
+
+    def complete(self):
+        if self.upload_id is None:
+            # small object: a single request
+            self.client.put_object(
+                Bucket=self.bucket,
+                Key=self.key,
+                Body=bytes(self.buffer),
+                Metadata=self.metadata,
+            )
+            return
+        if self.buffer:
+            self.flush_part()
+        self.client.complete_multipart_upload(
+            Bucket=self.bucket,
+            Key=self.key,
+            UploadId=self.upload_id,
+            MultipartUpload={"Parts": self.parts},
+        )
+
+    def abort(self):
+        if self.upload_id is not None:
+            self.client.abort_multipart_upload(
+                Bucket=self.bucket, Key=self.key, UploadId=self.upload_id
+            )
+
+
+class S3Storage(LocalStorage):
+    """
+    the web root is a bucket (and a prefix) of an S3-compatible object store
+    the endpoint is given by the AWS_ENDPOINT_URL environment variable (MinIO...)
+    modification times, upstream etags and symbolic links are object metadata
+    the local root is only a working directory (Go tools)
+    """
+
+    local = False
+
+    def __init__(self, url, root):
+        try:
+            import boto3
+        except ImportError:
+            raise RuntimeError("boto3 is required by the S3 storage")
+
+        super().__init__(root)
+        # the sizes and modification times read by the listings: most calls
+        # to stat do not need a request
+        self.listed = {}
+        url = urllib.parse.urlsplit(url)
+        self.bucket = url.netloc
+        self.prefix = url.path.strip("/")
+        self.client = boto3.client(
+            "s3", endpoint_url=os.environ.get("AWS_ENDPOINT_URL") or None
+        )
+
+    def key(self, name):
+        name = self.name(name)
+        return self.prefix + "/" + name if self.prefix else name
+
+    def head(self, name):
+        import botocore.exceptions
+
+        try:
+            return self.client.head_object(Bucket=self.bucket, Key=self.key(name))
+        except botocore.exceptions.ClientError as e:
+            if is_not_found(e):
+                return None
+            raise
+
+    def stat(self, name, metadata=False):
+        """
+        the modification time is the one of the object, or with `metadata`
+        the upstream one
+        the listed objects are not requested, except the empty ones that may
+        be symbolic links
+        """
+        if not metadata:
+            st = self.listed.get(self.name(name))
+            if st is not None and st["size"] > 0:
+                return dict(st)
+        head = self.head(name)
+        if head is None or "symlink" in head["Metadata"]:
+            return None
+        if not metadata:
+            return {
+                "size": head["ContentLength"],
+                "mtime": head["LastModified"].timestamp(),
+                "etag": None,
+            }
+        meta = head["Metadata"]
+        return {
+            "size": head["ContentLength"],
+            "mtime": float(meta.get("mtime", head["LastModified"].timestamp())),
+            "etag": meta.get("etag"),
+        }
+
+    def forget(self, name):
+        """
+        drop the listed metadata of a modified object
+        """
+        self.listed.pop(self.name(name), None)
+
+    def exists(self, name):
+        return self.stat(name) is not None
+
+    @contextlib.contextmanager
+    def open_write(self, name, mtime=None, etag=None):
+        metadata = {}
+        if mtime is not None:
+            metadata["mtime"] = str(mtime)
+        if etag is not None:
+            metadata["etag"] = etag
+        writer = MultipartWriter(self.client, self.bucket, self.key(name), metadata)
+        try:
+            yield writer
+        except BaseException:
+            writer.abort()
+            raise
+        writer.complete()
+        self.forget(name)
+
+    def write_bytes(self, name, data, mode=None):
+        self.client.put_object(Bucket=self.bucket, Key=self.key(name), Body=data)
+        self.forget(name)
+
+    def open_read(self, name):
+        import tempfile
+        import botocore.exceptions
+
+        # zipfile needs a seekable file
+        f = tempfile.SpooledTemporaryFile(PART_SIZE)
+        try:
+            self.client.download_fileobj(self.bucket, self.key(name), f)
+        except botocore.exceptions.ClientError as e:
+            f.close()
+            if is_not_found(e):
+                raise FileNotFoundError(self.key(name))
+            raise
+        f.seek(0)
+        return f
+
+    def read_bytes(self, name):
+        with self.open_read(name) as f:
+            return f.read()
+
+    def upload_file(self, local, name, mode=None):
+        # boto3 switches to multipart uploads for large files
+        mtime = os.stat(local).st_mtime
+        self.client.upload_file(
+            str(local),
+            self.bucket,
+            self.key(name),
+            ExtraArgs={"Metadata": {"mtime": str(mtime)}},
+        )
+        self.forget(name)
+
+    def symlink(self, name, target):
+        self.client.put_object(
+            Bucket=self.bucket,
+            Key=self.key(name),
+            Body=b"",
+            Metadata={"symlink": target},
+        )
+        self.forget(name)
+
+    def delete(self, name):
+        self.client.delete_object(Bucket=self.bucket, Key=self.key(name))
+        self.forget(name)
+
+    def list(self, prefix=""):
+        """
+        yield the names of the objects below a prefix, and remember their
+        sizes and modification times
+        symbolic links are empty objects: they are listed too, but `stat`
+        returns None for them
+        """
+        base = self.key(prefix) if prefix else self.prefix
+        if base:
+            base += "/"
+        paginator = self.client.get_paginator("list_objects_v2")
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=base):
+            for obj in page.get("Contents", []):
+                name = obj["Key"][len(self.prefix) + 1 if self.prefix else 0 :]
+                self.listed[name] = {
+                    "size": obj["Size"],
+                    "mtime": obj["LastModified"].timestamp(),
+                    "etag": None,
+                }
+                yield name
+
+
+def is_not_found(e):
+    """
+    tell if a botocore error is a missing object
+    """
+    return e.response["Error"]["Code"] in ("404", "NoSuchKey", "NotFound")
+
+
+def open_storage(url, root):
+    """
+    return the storage of the web root: s3://bucket/prefix or the local directory
+    """
+    if url is not None and url.startswith("s3://"):
+        return S3Storage(url, root)
+    return LocalStorage(root)
@@ -0,0 +1,131 @@
+"""
+integrity check of the mirror artifacts
+"""
+
+import logging
+import os
+import pathlib
+import time
+
+QUARANTINE_DIR = "quarantine"
+
+
+def check_zip(path):
+    """
+    check the central directory and the CRC of every member of a zip archive
+    """
+    import zipfile
+
+    try:
+        with zipfile.ZipFile(path) as z:
+            bad = z.testzip()
+    except (zipfile.BadZipFile, OSError, EOFError) as e:
+        return str(e)
+    if bad is not None:
+        return f"bad CRC for {bad}"
+
+
+def check_gzip(path):
+    """
+    check the CRC of a gzip stream
+    """
+    import gzip
+    import zlib
+
+    try:
+        with gzip.open(path) as f:
+            while f.read(1024 * 1024):
+                pass
+    except (OSError, EOFError, zlib.error) as e:
+        return str(e)
+
+
+def check_deb(path):
+    """
+    check the structure of a Debian package (ar archive)
+    """
+    size = os.path.getsize(path)
+    with open(path, "rb") as f:
+        if f.read(8) != b"!<arch>\n":
+            return "not an ar archive"
+        offset = 8
+        while offset < size:
+            header = f.read(60)
+            if len(header) != 60 or header[58:60] != b"`\n":
+                return f"bad member header at offset {offset}"
+            length = int(header[48:58])
+            offset += 60 + length + (length & 1)
+            f.seek(offset)
+    if offset != size:
+        return "truncated archive"
+
+
+def check_file(path):
+    """
+    check an artifact according to its type
+    return None if it is sound, the error otherwise
+    """
+    path = str(path)
+    if path.endswith((".vsix", ".zip")):
+        return check_zip(path)
+    if path.endswith((".tar.gz", ".tgz")):
+        return check_gzip(path)
+    if path.endswith(".deb"):
+        return check_deb(path)
+
+
+def is_checked(path):
+    """
+    tell if an artifact type is verified
+    """
+    return str(path).endswith((".vsix", ".zip", ".tar.gz", ".tgz", ".deb"))
+
+
+def quarantine(root, path, inventory=None):
+    """
+    move a corrupted artifact out of the mirror, so it will be downloaded again
+    """
+    root = pathlib.Path(root)
+    dest = root / QUARANTINE_DIR / f"{path}.{int(time.time())}"
+    dest.parent.mkdir(parents=True, exist_ok=True)
+    os.replace(root / path, dest)
+    if inventory is not None:
+        inventory.remove(path)
+    logging.warning("quarantined %s", dest.relative_to(root))
+    return dest
+
+
+def verify_mirror(root, inventory, jobs=None, force=False):
+    """
+    check the artifacts of the inventory in a process pool
+    the verified ones are flagged in the inventory, thus only new or modified
+    artifacts are checked next time
+    return the corrupted artifacts and their errors
+    """
+    from concurrent.futures import ProcessPoolExecutor
+
+    root = pathlib.Path(root)
+
+    todo = []
+    for path in sorted(inventory.files):
+        entry = inventory.stat(path)
+        if entry is None or not is_checked(path):
+            continue
+        if force or not entry.get("verified"):
+            todo.append(path)
+
+    logging.info("verifying %d artifacts", len(todo))
+
+    corrupted = {}
+    with ProcessPoolExecutor(jobs) as pool:
+        # the largest archives first, to balance the workers
+        todo.sort(key=lambda path: inventory.get(path)["size"], reverse=True)
+        errors = pool.map(check_file, [root / path for path in todo], chunksize=1)
+        for path, error in zip(todo, errors):
+            if error is None:
+                inventory.get(path)["verified"] = True
+            else:
+                logging.error("corrupted %s: %s", path, error)
+                corrupted[path] = error
+
+    return corrupted
@@ -2,34 +2,79 @@
 # rene-d 2018
 # modified DaeHyun Sung, 2023.
 
+# Nota: the heavy modules (requests, requests_cache, yaml, dateutil, zipfile,
+# email, asyncio, http.server) are imported where they are used, to keep the startup
+# fast for the actions that do not need them. See tests/importtime.sh.
+
 import argparse
-import bz2
+import contextlib
 import datetime
-import email.utils
+import hashlib
+import itertools
 import json
 import logging
 import os
 import pathlib
+import random
 import re
 import subprocess
 import sys
+import threading
+import time
+import urllib.parse
 from collections import defaultdict
-from operator import itemgetter
-
-import dateutil.parser
-import requests
-import requests_cache
-import yaml
-import shutil
-import urllib
-import zipfile
-import pkg_resources
+from functools import partial
+
+try:
+    from .events import configure as configure_events, events
+    from .inventory import INVENTORY_FILE, Inventory
+    from .jsonstream import Reader as JSONReader
+    from . import bundle
+    from .generations import Generations
+    from . import retention
+    from .storage import LocalStorage, open_storage
+    from . import verify
+except ImportError:
+    # run directly from source
+    from events import configure as configure_events, events
+    from inventory import INVENTORY_FILE, Inventory
+    from jsonstream import Reader as JSONReader
+    import bundle
+    from generations import Generations
+    import retention
+    from storage import LocalStorage, open_storage
+    import verify
 
 ################################
 
 CPPTOOLS_KEY = "ms-vscode.cpptools"
 CPPTOOLS_PLATFORMS = ["linux", "win32", "osx", "linux32"]
 
+# maximum number of items waiting between two stages of the sync pipeline
+QUEUE_SIZE = 16
+
+# size of the chunks of the downloads
+CHUNK_SIZE = 64 * 1024
+
+# number of extensions of a page of the gallery queries
+QUERY_PAGE_SIZE = 100
+
+# directory and page size of the catalog of index.html
+CATALOG_DIR = "catalog"
+CATALOG_PAGE_SIZE = 100
+
+# directory of the extracted extensions in the web root
+TREE_DIR = "tree"
+
+# directory of the Go module proxy in the web root
+GO_PROXY_DIR = "goproxy"
+
+# number of generations in the changes feed
+CHANGES_KEPT = 50
+
+# extensions directories of Code and of the remote server
+EXTENSIONS_DIRS = ["~/.vscode/extensions", "~/.vscode-server/extensions"]
+
 ################################
 
 if sys.stdout.encoding != "UTF-8":
@@ -56,62 +101,197 @@ CHECK_MARK = "\033[32m\N{check mark}\033[0m"  # ✔
 HEAVY_BALLOT_X = "\033[31m\N{heavy ballot x}\033[0m"  # ✘
 
 
+# HTTP session shared by all requests, to reuse the connections
+_session = None
+
+# True when the Requests cache is installed (--cache)
+_cache_installed = False
+
+# storage of the web root (--storage)
+_storage = None
+
+
+def get_session():
+    """
+    return the HTTP session
+    """
+    global _session
+    if _session is None:
+        import requests
+
+        _session = requests.Session()
+    return _session
+
+
+def get_storage():
+    """
+    return the storage of the web root
+    """
+    global _storage
+    if _storage is None:
+        _storage = LocalStorage(".")
+    return _storage
+
+
+def cache_disabled():
+    """
+    context manager that bypasses the Requests cache, if installed
+    """
+    if _cache_installed:
+        import requests_cache
+
+        return requests_cache.disabled()
+    return contextlib.ExitStack()
+
+
+def resource_path(name):
+    """
+    return the path of a file shipped with the package
+    """
+    if __package__:
+        try:
+            from importlib.resources import files
+        except ImportError:
+            # Python < 3.9: the package is always installed as plain files
+            pass
+        else:
+            return files(__package__).joinpath(name)
+    return pathlib.Path(__file__).parent / name
+
+
+class Config:
+    """
+    the configuration file, loaded once
+    """
+
+    def __init__(self, path=None, web_root=None, extensions=(), queries=(), raw=None):
+        self.path = path
+        self.web_root = web_root
+        self.extensions = list(extensions)
+        self.queries = list(queries)
+        self.raw = raw or {}
+        self.mtime = None
+
+    @classmethod
+    def load(cls, path):
+        """
+        parse a YAML configuration file
+        """
+        import yaml
+
+        # all values are kept as strings, the libyaml parser is much faster
+        loader = getattr(yaml, "CBaseLoader", yaml.BaseLoader)
+        with open(path) as f:
+            raw = yaml.load(f, Loader=loader) or {}
+
+        config = cls(
+            path=path,
+            web_root=raw.get("web_root"),
+            extensions=raw.get("extensions") or [],
+            queries=[parse_query(q) for q in raw.get("queries") or []],
+            raw=raw,
+        )
+        config.mtime = os.stat(path).st_mtime
+        return config
+
+    def is_modified(self):
+        """
+        tell if the file has changed since it has been loaded
+        """
+        try:
+            return self.path is not None and os.stat(self.path).st_mtime != self.mtime
+        except OSError:
+            return False
+
+
+def parse_query(entry):
+    """
+    validate a gallery query of the configuration file:
+    the most installed extensions, optionally of a category or with a tag
+    """
+
+    if not isinstance(entry, dict) or not set(entry) <= {"top", "category", "tag"}:
+        raise ValueError(f"bad query: {entry!r}")
+    query = {k: entry[k] for k in ("category", "tag") if entry.get(k)}
+    top = entry.get("top")
+    if top is not None:
+        if not str(top).isdigit() or int(top) == 0:
+            raise ValueError(f"bad query count: {entry!r}")
+        query["top"] = int(top)
+    elif not query:
+        # the whole marketplace is not an option
+        raise ValueError(f"unbounded query: {entry!r}")
+    return query
+
+
 def my_parsedate(text):
     """
     parse date from http headers response
     """
+    import email.utils
+
     return datetime.datetime(*email.utils.parsedate(text)[:6])
 
 
-def download(url, file):
+def download(url, file, key=None):
     """
-    download a file and set last modified time
+    download a file into the storage and set last modified time
+    the upstream etag is kept to skip the unchanged files next time
     """
 
-    if isinstance(file, str):
-        file = pathlib.Path(file)
+    import email.utils
 
-    file.parent.mkdir(exist_ok=True, parents=True)
+    storage = get_storage()
+    name = storage.name(file)
+    if key is None:
+        key = pathlib.PurePosixPath(name).name
 
-    with requests_cache.disabled():
+    with cache_disabled():
 
         headers = {}
-        if os.path.isfile(file):
+        st = storage.stat(name, metadata=True)
+        if st is not None:
             headers["If-Modified-Since"] = email.utils.format_datetime(
-                datetime.datetime.fromtimestamp(os.stat(file).st_mtime)
+                datetime.datetime.fromtimestamp(st["mtime"])
             )
+            if st["etag"]:
+                headers["If-None-Match"] = st["etag"]
 
-        with requests.get(url, stream=True, allow_redirects=True, headers=headers) as r:
+        with get_session().get(
+            url, stream=True, allow_redirects=True, headers=headers
+        ) as r:
             if r.status_code == 200:
-                d = os.path.dirname(file)
-                if d != "":
-                    os.makedirs(d, exist_ok=True)
-                with open(file, "wb") as f:
-                    for chunk in r.iter_content(chunk_size=4096):
-                        f.write(chunk)
+                size = r.headers.get("content-length")
+                events.artifact_started(key, int(size) if size else None)
+                mtime = None
                 if r.headers.get("last-modified"):
-                    d = my_parsedate(r.headers["last-modified"])
-                    timestamp = d.timestamp()
-                    try:
-                        os.utime(file, (timestamp, timestamp))
-                    except OSError:
-                        pass
+                    mtime = my_parsedate(r.headers["last-modified"]).timestamp()
+                written = 0
+                # the file is streamed into the storage, no local copy is made
+                with storage.open_write(name, mtime, r.headers.get("etag")) as f:
+                    for chunk in r.iter_content(chunk_size=CHUNK_SIZE):
+                        f.write(chunk)
+                        written += len(chunk)
+                        events.bytes_transferred(key, len(chunk))
+                events.artifact_done(key, True, written, r.status_code)
                 return True
 
             elif r.status_code == 304:
                 # Not Modified
+                events.artifact_done(key, True, status=r.status_code)
                 return True
 
             else:
                 print(HEAVY_BALLOT_X, r.status_code, url)
+                events.artifact_done(key, False, status=r.status_code)
                 return False
 
 
 # cf. vs/platform/extensionManagement/node/extensionGalleryService.ts
 class FilterType:
-    #   Tag = 1
+    Tag = 1
     ExtensionId = 4
-    #   Category = 5
+    Category = 5
     ExtensionName = 7
     Target = 8
     #   Featured = 9
@@ -134,6 +314,23 @@ class Flags:
     Unpublished = 0x1000
 
 
+class SortBy:
+    #   NoneOrRelevance = 0
+    #   LastUpdatedDate = 1
+    #   Title = 2
+    #   PublisherName = 3
+    InstallCount = 4
+    #   PublishedDate = 5
+    #   AverageRating = 6
+    #   WeightedRating = 12
+
+
+class SortOrder:
+    #   Default = 0
+    #   Ascending = 1
+    Descending = 2
+
+
 def is_engine_valid(engine, extension):
     """
     check if extension version <= engine version
@@ -164,6 +361,7 @@ def is_engine_valid(engine, extension):
 def get_extensions(extensions, vscode_engine):
     """
     retrieve from server the extension list with engine version validated
+    extensions are yielded as soon as they are validated
     """
 
     # proceed in two times, like VSCode, to reduce bandwidth consumption
@@ -196,66 +394,60 @@ def get_extensions(extensions, vscode_engine):
             {"filterType": FilterType.ExtensionName, "value": ext}
         )
 
-    headers = {
-        "Content-type": "application/json",
-        "Accept": "application/json;api-version=3.0-preview.1",
-    }
-
     # query the gallery
     logging.debug("query IncludeLatestVersionOnly")
     # json.dump(data, open("query1.json", "w"), indent=2)
 
-    req = requests.post(
-        "https://marketplace.visualstudio.com/_apis/public/gallery/extensionquery",
-        json=data,
-        headers=headers,
-    )
-    res = req.json()
-
-    # json.dump(res, open("response1.json", "w"), indent=2)
+    events.query_started("IncludeLatestVersionOnly", len(extensions))
+    results = gallery_query(data)
+    events.query_finished("IncludeLatestVersionOnly", len(results))
 
     # analyze the response
     not_compatible = []
-    result = []
 
-    if "results" in res and "extensions" in res["results"][0]:
-        for e in res["results"][0]["extensions"]:
+    for e in results:
+        if is_compatible(e, vscode_engine):
+            yield e
+        else:
+            # we will look for a suitable version later
+            not_compatible.append(e["extensionId"])
 
-            logging.debug(
-                "%s.%s %s",
-                e["publisher"]["publisherName"],
-                e["extensionName"],
-                e["versions"][0]["version"],
-            )
+    yield from get_compatible_versions(not_compatible, vscode_engine)
 
-            engines = list(
-                p["value"]
-                for p in e["versions"][0]["properties"]
-                if p["key"] == "Microsoft.VisualStudio.Code.Engine"
-            )
-            for engine in engines:
-                if is_engine_valid(vscode_engine, engine):
-                    break
-            else:
-                logging.warning(
-                    "engine %r does not match engine %s", engines, vscode_engine
-                )
-                # we will look for a suitable version later
-                not_compatible.append(e["extensionId"])
-                continue
 
-            # logging.debug(
-            #     "OK: '%s | %s | %s | %s",
-            #     e["displayName"],
-            #     e.get("shortDescription", e["displayName"]),
-            #     e["publisher"]["displayName"],
-            #     e["versions"][0]["version"],
-            # )
-            result.append(e)
+def is_compatible(e, vscode_engine):
+    """
+    tell if the latest version of an extension fits the engine version
+    """
+
+    logging.debug(
+        "%s.%s %s",
+        e["publisher"]["publisherName"],
+        e["extensionName"],
+        e["versions"][0]["version"],
+    )
+
+    engines = list(
+        p["value"]
+        for p in e["versions"][0]["properties"]
+        if p["key"] == "Microsoft.VisualStudio.Code.Engine"
+    )
+    for engine in engines:
+        if is_engine_valid(vscode_engine, engine):
+            return True
+    logging.warning("engine %r does not match engine %s", engines, vscode_engine)
+    return False
+
+
+def get_compatible_versions(not_compatible, vscode_engine):
+    """
+    retrieve from server the greatest versions of extensions (by id) that fit
+    the engine version
+    """
 
     if len(not_compatible) == 0:
         # we have all we need
-        return result
+        return
 
     # prepare the second query
     data = {
@@ -282,91 +474,295 @@ def get_extensions(extensions, vscode_engine):
             {"filterType": FilterType.ExtensionId, "value": id}
         )
 
+    def select(versions):
+        """
+        find the greatest version compatible with our vscode engine
+        versions are judged while they are read, only the best one is kept
+        """
+
+        count = 0
+        max_vernum = []
+        max_version = None
+        max_engine = None
+        latest = None
+
+        for v in versions:
+            count += 1
+            if latest is None:
+                latest = v
+            if "properties" not in v:
+                continue
+
+            engine = None
+            for p in v["properties"]:
+                if p["key"] == "Microsoft.VisualStudio.Code.Engine":
+                    engine = p["value"]
+            if engine:
+                is_valid = is_engine_valid(vscode_engine, engine)
+                # logging.debug("found version %s engine %s : %s", v["version"], engine, is_valid)
+                if is_valid:
+                    # well, it seems that versions are sorted latest first
+                    # but I prefer looking for the greatest version number
+                    vernum = list(map(int, v["version"].split(".")))
+                    if vernum > max_vernum:
+                        max_vernum = vernum
+                        max_version = v
+                        max_engine = engine
+
+        logging.debug("analyzed %d versions", count)
+        if max_version:
+            logging.debug(
+                "version %s is the best suitable choice, engine %s",
+                max_version["version"],
+                max_engine,
+            )
+            return [max_version]
+
+        logging.error("no suitable version found")
+        return [latest] if latest else []
+
     # query the gallery
     logging.debug("query IncludeVersions")
     # json.dump(data, open("query2.json", "w"), indent=2)
-    req = requests.post(
+    events.query_started("IncludeVersions", len(not_compatible))
+    results = gallery_query(data, select)
+    events.query_finished("IncludeVersions", len(results))
+
+    for e in results:
+        logging.debug(
+            "%s.%s %s",
+            e["publisher"]["publisherName"],
+            e["extensionName"],
+            e["versions"][0]["version"] if e["versions"] else None,
+        )
+        yield e
+
+
+def query_extensions(query, vscode_engine):
+    """
+    retrieve from server the most installed extensions of a query of the
+    configuration file, page by page: the extensions are yielded as soon as
+    their page is received
+    """
+
+    criteria = [
+        {"filterType": FilterType.Target, "value": "Microsoft.VisualStudio.Code"},
+        {"filterType": FilterType.ExcludeWithFlags, "value": str(Flags.Unpublished)},
+    ]
+    if "category" in query:
+        criteria.append({"filterType": FilterType.Category, "value": query["category"]})
+    if "tag" in query:
+        criteria.append({"filterType": FilterType.Tag, "value": query["tag"]})
+
+    top = query.get("top")
+    name = " ".join(f"{k}={v}" for k, v in sorted(query.items()))
+    count = 0
+    page = 1
+
+    while top is None or count < top:
+        size = QUERY_PAGE_SIZE if top is None else min(QUERY_PAGE_SIZE, top - count)
+        data = {
+            "filters": [
+                {
+                    "criteria": criteria,
+                    "pageNumber": page,
+                    # the page size is constant, otherwise the pages overlap
+                    "pageSize": QUERY_PAGE_SIZE,
+                    "sortBy": SortBy.InstallCount,
+                    "sortOrder": SortOrder.Descending,
+                }
+            ],
+            "flags": Flags.IncludeLatestVersionOnly
+            + Flags.IncludeAssetUri
+            + Flags.IncludeVersionProperties,
+        }
+
+        logging.debug("query %s page %d", name, page)
+        events.query_started(f"{name} page {page}", size)
+
+        # the page is read before it is processed: the connection is not
+        # kept open while the pipeline is busy
+        results = gallery_query(data)
+        events.query_finished(f"{name} page {page}", len(results))
+
+        # the last page is truncated to the count
+        not_compatible = []
+        for e in results[:size]:
+            if is_compatible(e, vscode_engine):
+                yield e
+            else:
+                not_compatible.append(e["extensionId"])
+        yield from get_compatible_versions(not_compatible, vscode_engine)
+
+        count += min(len(results), size)
+        if len(results) < QUERY_PAGE_SIZE:
+            # last page
+            break
+        page += 1
+
+    logging.info("query %s: %d extensions", name, count)
+
+
+def gallery_query(data, select=None):
+    """
+    post a query to the gallery and read the extensions of the response as a
+    stream: the whole document is never loaded
+    `select` reduces the versions of an extension while they are read
+    """
+
+    headers = {
+        "Content-type": "application/json",
+        "Accept": "application/json;api-version=3.0-preview.1",
+    }
+
+    extensions = []
+    with get_session().post(
         "https://marketplace.visualstudio.com/_apis/public/gallery/extensionquery",
         json=data,
         headers=headers,
+        stream=True,
+    ) as r:
+        reader = JSONReader(r.iter_content(chunk_size=CHUNK_SIZE))
+        for _ in reader.iter_path(["results", "extensions"]):
+            e = {}
+            for key in reader.iter_object():
+                if key == "versions" and select is not None:
+                    e[key] = select(reader.value() for _ in reader.iter_array())
+                else:
+                    e[key] = reader.value()
+            extensions.append(e)
+    return extensions
+
+
+def extension_dependencies(e, dst_dir=None):
+    """
+    return the extensions required by an extension: its dependencies and,
+    for an extension pack, its members
+    properties of the gallery response are used, or the vsix manifest if it
+    is already mirrored
+    """
+
+    keys = (
+        "Microsoft.VisualStudio.Code.ExtensionDependencies",
+        "Microsoft.VisualStudio.Code.ExtensionPack",
     )
-    res = req.json()
-    # json.dump(res, open("response2.json", "w"), indent=2)
 
-    if "results" in res and "extensions" in res["results"][0]:
-        for e in res["results"][0]["extensions"]:
+    version = e["versions"][0]
+    values = [p["value"] for p in version.get("properties", []) if p["key"] in keys]
 
-            logging.debug(
-                "analyze %s.%s (%d versions)",
-                e["publisher"]["publisherName"],
-                e["extensionName"],
-                len(e["versions"]),
-            )
+    if "properties" not in version and dst_dir is not None:
+        key = e["publisher"]["publisherName"] + "." + e["extensionName"]
+        vsix = dst_dir / "vsix" / (key + "-" + version["version"] + ".vsix")
+        manifest = read_manifest(vsix)
+        values = [
+            ",".join(manifest.get("extensionDependencies", [])),
+            ",".join(manifest.get("extensionPack", [])),
+        ]
+
+    dependencies = set()
+    for value in values:
+        for dep in value.split(","):
+            dep = dep.strip()
+            # built-in extensions are not in the gallery
+            if dep and not dep.lower().startswith("vscode."):
+                dependencies.add(dep)
+    return dependencies
+
+
+def read_manifest(vsix):
+    """
+    read the package.json of a vsix
+    """
 
-            # find the greatest version compatible with our vscode engine
-            max_vernum = []
-            max_version = None
-            max_engine = None
+    import zipfile
 
-            for v in e["versions"]:
-                if "properties" not in v:
-                    continue
+    try:
+        with get_storage().open_read(vsix) as f, zipfile.ZipFile(f) as z:
+            return json.loads(z.read("extension/package.json"))
+    except (OSError, KeyError, ValueError, zipfile.BadZipFile):
+        return {}
 
-                engine = None
-                for p in v["properties"]:
-                    if p["key"] == "Microsoft.VisualStudio.Code.Engine":
-                        engine = p["value"]
-                if engine:
-                    is_valid = is_engine_valid(vscode_engine, engine)
-                    # logging.debug("found version %s engine %s : %s", v["version"], engine, is_valid)
-                    if is_valid:
-                        # well, it seems that versions are sorted latest first
-                        # but I prefer looking for the greatest version number
-                        vernum = list(map(int, v["version"].split(".")))
-                        if vernum > max_vernum:
-                            max_vernum = vernum
-                            max_version = v
-                            max_engine = engine
-
-            if max_version:
-                logging.debug(
-                    "version %s is the best suitable choice, engine %s",
-                    max_version["version"],
-                    max_engine,
-                )
-                e["versions"] = [max_version]
-            else:
-                logging.error("no suitable version found")
 
-            result.append(e)
+def resolve_extensions(
+    extensions, vscode_engine, dependencies=True, dst_dir=None, queries=(), shard=None
+):
+    """
+    retrieve from server the extensions, the results of the gallery queries and
+    the transitive closure of their dependencies: one batched query for each
+    dependency depth
+    the results of the queries are restricted to the shard, if any
+    """
+
+    seen = set(ext.lower() for ext in extensions)
+    batch = list(extensions)
+    depth = 0
 
-    return result
+    def paged():
+        for query in queries:
+            for e in query_extensions(query, vscode_engine):
+                key = e["publisher"]["publisherName"] + "." + e["extensionName"]
+                if key.lower() in seen:
+                    continue
+                if shard and not in_shard(key, shard):
+                    continue
+                seen.add(key.lower())
+                yield e
+
+    while batch or queries:
+        missing = set()
+        results = get_extensions(batch, vscode_engine) if batch else ()
+        if depth == 0:
+            # the pages of the queries follow the listed extensions
+            results = itertools.chain(results, paged())
+        for e in results:
+            yield e
+            if not dependencies:
+                continue
+            for dep in extension_dependencies(e, dst_dir):
+                if dep.lower() not in seen:
+                    seen.add(dep.lower())
+                    missing.add(dep)
+
+        batch = sorted(missing)
+        queries = ()
+        depth += 1
+        if batch:
+            logging.info(
+                "resolving %d dependencies (depth %d): %s",
+                len(batch),
+                depth,
+                " ".join(batch),
+            )
 
 
 def parse_date(d):
     """
     return a suitable date for markdown
     """
+    import dateutil.parser
+
     return dateutil.parser.parse(d).strftime("%Y/%m/%d&nbsp;%H:%M:%S")
 
 
 def process_cpptools(dst_dir, json_data, e):
     """
     download the online installer for C/C++ extension
+    return the keys of the added platform extensions
     """
 
     key = CPPTOOLS_KEY
     version = e["versions"][0]["version"]
 
     platforms = ["linux"]
+    added = []
 
     # fetch all releases
-    releases = requests.get(
+    releases = get_session().get(
         "https://api.github.com/repos/Microsoft/vscode-cpptools/releases"
     )
 
     if releases.status_code != 200:
-        return
+        return added
 
     # request is successfull
     for release in releases.json():
@@ -407,6 +803,76 @@ def process_cpptools(dst_dir, json_data, e):
                 "lastUpdated": parse_date(asset["updated_at"]),
                 "platform": platform,
             }
+            added.append(key2)
+
+    return added
+
+
+def go_download(import_path, env, dry_run):
+    """
+    download a Go tool and its dependencies into the module cache
+    return the exit code of the go commands
+    """
+
+    import tempfile
+
+    cmds = [
+        ["go", "mod", "init", "vscode-dl/tools"],
+        ["go", "get", import_path + "@latest"],
+        ["go", "mod", "download", "all"],
+    ]
+    if dry_run:
+        print(cmds[1])
+        return 0
+
+    with tempfile.TemporaryDirectory() as tmp:
+        for cmd in cmds:
+            rc = subprocess.call(
+                cmd,
+                cwd=tmp,
+                env=env,
+                stderr=subprocess.DEVNULL,
+                stdout=subprocess.DEVNULL,
+            )
+            if rc != 0:
+                return rc
+    return 0
+
+
+def publish_go_proxy(dst_dir, go_path):
+    """
+    copy the module cache into the web root, in GOPROXY layout: it can be used
+    as is with GOPROXY=<mirror url>/goproxy
+    only the files added or modified since the previous sync are copied
+    """
+
+    storage = get_storage()
+    cache = go_path / "pkg" / "mod" / "cache" / "download"
+    copied = 0
+    # one listing instead of a request for each file
+    published = set(storage.list(dst_dir / GO_PROXY_DIR))
+    for dirpath, dirnames, filenames in os.walk(cache):
+        rel = pathlib.Path(dirpath).relative_to(cache)
+        if rel == pathlib.Path("."):
+            # checksum database tiles, not part of the proxy protocol
+            dirnames[:] = [d for d in dirnames if d != "sumdb"]
+        for filename in filenames:
+            if filename != "list" and not filename.endswith((".info", ".mod", ".zip")):
+                continue
+            local = os.path.join(dirpath, filename)
+            name = dst_dir / GO_PROXY_DIR / rel / filename
+            local_st = os.stat(local)
+            # the copy is not older than the local file
+            st = storage.stat(name) if storage.name(name) in published else None
+            if (
+                st is not None
+                and st["size"] == local_st.st_size
+                and int(st["mtime"]) >= int(local_st.st_mtime)
+            ):
+                continue
+            storage.upload_file(local, name)
+            copied += 1
+    logging.debug("%d files copied into %s", copied, GO_PROXY_DIR)
 
 
 def dl_go_packages(dst_dir, vsix, json_data, dry_run, isImportant=True):
@@ -425,14 +891,16 @@ def dl_go_packages(dst_dir, vsix, json_data, dry_run, isImportant=True):
     env = os.environ.copy()
     env["GOPATH"] = go_path.as_posix()
 
+    import zipfile
+
     # get the list of tools
-    z = zipfile.ZipFile(vsix)
-    try:
-        # extensions 0.16+
-        js = z.read("extension/dist/goMain.js")
-    except KeyError:
-        # extensions -> 0.15.2
-        js = z.read("extension/out/src/goTools.js")
+    with get_storage().open_read(vsix) as f, zipfile.ZipFile(f) as z:
+        try:
+            # extensions 0.16+
+            js = z.read("extension/dist/goMain.js")
+        except KeyError:
+            # extensions -> 0.15.2
+            js = z.read("extension/out/src/goTools.js")
 
     m = re.search(rb"allToolsInformation = ({.+?\n});\n", js, re.DOTALL)
 
@@ -454,273 +922,786 @@ def dl_go_packages(dst_dir, vsix, json_data, dry_run, isImportant=True):
                 tools[tool["name"]] = tool
                 # print("  tool detected: {} - {}".format(tool["name"], tool["description"]))
 
-    # issue a "go get" command for each tool
+    # download each tool into the module cache, as `go install tool@latest`
+    # would do: a temporary module for each tool, so that its dependencies
+    # are resolved independently of the other tools
+    env["GO111MODULE"] = "on"
+    env["GOFLAGS"] = "-modcacherw"
     max_length = max(len(tool["importPath"]) for tool in tools.values())
     fmt = "    {importPath:%d} {description} {flag}     " % (
         ((max_length + 7) // 8) * 8 + 4
     )
     for tool in tools.values():
         flag = ["📢", "📣"][tool["isImportant"]]
-        print(fmt.format(**tool, flag=flag), end="")
-        sys.stdout.flush()
+        # print whole lines: other stages of the pipeline are printing too
+        line = fmt.format(**tool, flag=flag)
         if isImportant or tool["isImportant"]:
-            cmd = ["go", "get", "-u", "-d", tool["importPath"]]
-            if dry_run:
-                rc = 0
-                print(cmd)
-            else:
-                rc = subprocess.call(
-                    cmd, env=env, stderr=subprocess.DEVNULL, stdout=subprocess.DEVNULL
-                )
-            print([HEAVY_BALLOT_X, CHECK_MARK][rc == 0])
+            events.artifact_queued(tool["name"], tool["importPath"], go_path)
+            rc = go_download(tool["importPath"], env, dry_run)
+            print(line + [HEAVY_BALLOT_X, CHECK_MARK][rc == 0])
+            events.artifact_done(tool["name"], rc == 0, status=rc)
         else:
-            print(" skipping")
+            print(line + " skipping")
 
-    # make an archive with Go tools
-    cmd = ["tar", "-czf", "go-tools.tar.gz", "go"]
-    if dry_run:
-        print(cmd)
-    else:
-        subprocess.call(cmd, cwd=dst_dir.as_posix())
+    if not dry_run:
+        publish_go_proxy(dst_dir, go_path)
+        json_data["go-proxy"] = GO_PROXY_DIR
 
-        sh = dst_dir / "go-tools.sh"
-        sh.write_text(
-            "#!/bin/sh\n" +
-            "go get \\\n  " +
-            " \\\n  ".join(tool["importPath"] for tool in tools.values()) +
-            "\n")
-        sh.chmod(0o755)
+        sh = "#!/bin/sh\n# GOPROXY=<mirror url>/goproxy GOSUMDB=off\n" + "".join(
+            f"go install {tool['importPath']}@latest\n" for tool in tools.values()
+        )
+        get_storage().write_bytes(dst_dir / "go-tools.sh", sh.encode(), mode=0o755)
 
     json_data["go-tools"] = tools
+    events.phase_done("go-tools")
 
 
-def dl_extensions(dst_dir, extensions, json_data, engine_version, dry_run, no_golang):
+def extension_data(e):
     """
-    download or update extensions
+    build the catalog record of an extension from the gallery response
     """
 
-    response = get_extensions(extensions, engine_version)
-
-    # analyze the response
-    for e in response:
-        # DEBUG 1
-        # print(json.dumps(e, indent=4))
-
-        # DEBUG 2
-        # print("displayName             :", e["displayName"])
-        # print("extensionName           :", e["extensionName"])
-        # print("shortDescription        :", e["shortDescription"])
-        # print("publisher.publisherName :", e["publisher"]["publisherName"])
-        # print("publisher.displayName   :", e["publisher"]["displayName"])
-
-        # for i, v in enumerate(e["versions"]):
-        #     print(f"version[{i}]              :", v["version"])
-        #     print(f"assetUri[{i}]             :", v["assetUri"])
-        # assert len(e["versions"]) == 1
-        # print()
-
-        # unique extension identifier, like "ms-python.python"
-        key = e["publisher"]["publisherName"] + "." + e["extensionName"]
-
-        if key == CPPTOOLS_KEY:
-            process_cpptools(dst_dir, json_data, e)
-        else:
-            version = e["versions"][0]["version"]
+    # unique extension identifier, like "ms-python.python"
+    key = e["publisher"]["publisherName"] + "." + e["extensionName"]
+    version = e["versions"][0]["version"]
 
-            json_data["extensions"][key] = {
-                "version": version,
-                "vsix": "vsix/" + (key + "-" + version + ".vsix"),
-                "vsixAsset": e["versions"][0]["assetUri"]
-                + "/Microsoft.VisualStudio.Services.VSIXPackage",
-                "url": "https://marketplace.visualstudio.com/items?itemName=" + key,
-                "icon": "icons/" + (key + ".png"),
-                "iconAsset": f'{e["versions"][0]["assetUri"]}/Microsoft.VisualStudio.Services.Icons.Small',
-                "name": e["displayName"],
-                "description": e.get("shortDescription", e["displayName"]),
-                "author": e["publisher"]["displayName"],
-                "authorUrl": "https://marketplace.visualstudio.com/publishers/"
-                + e["publisher"]["publisherName"],
-                "lastUpdated": parse_date(e["versions"][0]["lastUpdated"]),
-                # "platform": ""
-            }
+    return {
+        "version": version,
+        "vsix": "vsix/" + (key + "-" + version + ".vsix"),
+        "vsixAsset": e["versions"][0]["assetUri"]
+        + "/Microsoft.VisualStudio.Services.VSIXPackage",
+        "url": "https://marketplace.visualstudio.com/items?itemName=" + key,
+        "icon": "icons/" + (key + ".png"),
+        "iconAsset": f'{e["versions"][0]["assetUri"]}/Microsoft.VisualStudio.Services.Icons.Small',
+        "name": e["displayName"],
+        "description": e.get("shortDescription", e["displayName"]),
+        "author": e["publisher"]["displayName"],
+        "authorUrl": "https://marketplace.visualstudio.com/publishers/"
+        + e["publisher"]["publisherName"],
+        "lastUpdated": parse_date(e["versions"][0]["lastUpdated"]),
+        # "platform": ""
+    }
 
-    # print(json.dumps(json_data["extensions"], indent=4))
 
-    for key, data in json_data["extensions"].items():
+def fetch_extension(dst_dir, key, data, dry_run):
+    """
+    download the vsix and the icon of an extension
+    """
 
-        vsix = dst_dir / data["vsix"]
-        icon = dst_dir / data["icon"]
+    storage = get_storage()
+    vsix = dst_dir / data["vsix"]
+    icon = dst_dir / data["icon"]
 
-        # download vsix
-        if not vsix.is_file():
-            if icon.is_file():
-                icon.unlink()
-            print(
-                "{:20} {:35} {:10} {} downloading...".format(
-                    *key.split("."), data["version"], HEAVY_BALLOT_X
-                )
+    # download vsix
+    if not storage.exists(vsix):
+        storage.delete(icon)
+        print(
+            "{:20} {:35} {:10} {} downloading...".format(
+                *key.split("."), data["version"], HEAVY_BALLOT_X
             )
-            if not dry_run:
-                download(data["vsixAsset"], vsix)
+        )
+        events.artifact_queued(key, data["vsixAsset"], data["vsix"])
+        if not dry_run:
+            download(data["vsixAsset"], vsix, key)
+    else:
+        print(
+            "{:20} {:35} {:10} {}".format(*key.split("."), data["version"], CHECK_MARK)
+        )
+
+    # download icon
+    if not storage.exists(icon):
+        if not dry_run:
+            ok = download(data["iconAsset"], icon)
         else:
-            print(
-                "{:20} {:35} {:10} {}".format(
-                    *key.split("."), data["version"], CHECK_MARK
-                )
-            )
+            ok = True
+        if not ok:
+            # default icon: { visual studio code }
+            url = "https://cdn.vsassets.io/v/20180521T120403/_content/Header/default_icon.png"
+            download(url, icon)
 
-        # download icon
-        if not icon.is_file():
-            if not dry_run:
-                ok = download(data["iconAsset"], icon)
-            else:
-                ok = True
-            if not ok:
-                # default icon: { visual studio code }
-                url = "https://cdn.vsassets.io/v/20180521T120403/_content/Header/default_icon.png"
-                download(url, icon)
 
-        if key == "golang.Go":
-            dl_go_packages(dst_dir, vsix, json_data, dry_run)
+def check_artifact(dst_dir, path, inventory=None):
+    """
+    verify a downloaded artifact, unless the inventory knows it is sound
+    a corrupted artifact is quarantined and False is returned
+    artifacts of a remote storage are not verified
+    """
 
-    # write the markdown catalog file
-    with open(dst_dir / "extensions.md", "w") as f:
+    if not get_storage().local or not (dst_dir / path).is_file():
+        return True
 
-        md = ["Icon", "Name", "Description", "Author", "Version", "Date"]
+    entry = inventory.stat(path) if inventory is not None else None
+    if entry is None or not entry.get("verified"):
+        error = verify.check_file(dst_dir / path)
+        if error is not None:
+            logging.error("corrupted %s: %s", path, error)
+            verify.quarantine(dst_dir, path, inventory)
+            return False
+        if entry is not None:
+            entry["verified"] = True
 
-        print("|".join(md), file=f)
-        print("|".join(["-" * len(i) for i in md]), file=f)
+    return True
 
-        for key, data in json_data["extensions"].items():
 
-            def new_row(data):
-                md[0] = "![{name}]({icon})".format_map(data)
-                md[1] = "[{name}]({url})".format_map(data)
-                md[2] = data["description"]
-                md[3] = "[{author}]({authorUrl})".format_map(data)
-                md[4] = "[{version}]({vsix})".format_map(data)
-                md[5] = data["lastUpdated"]
+def check_extension(
+    dst_dir, key, data, json_data, dry_run, no_golang, inventory=None, extract=False
+):
+    """
+    verify a downloaded vsix, extract the Go tools and the extension tree
+    a corrupted vsix is quarantined and False is returned
+    """
 
-                print("|".join(md), file=f)
+    vsix = dst_dir / data["vsix"]
 
-            new_row(data)
+    if not check_artifact(dst_dir, data["vsix"], inventory):
+        return False
 
+    if key == "golang.Go" and not no_golang:
+        dl_go_packages(dst_dir, vsix, json_data, dry_run)
 
-def dl_code(dst_dir, channel="stable", revision="latest"):
-    """
-    download code for Linux from Microsoft debian-like repo
-    """
+    if extract and not dry_run:
+        data["tree"] = extract_extension(dst_dir, data["vsix"], inventory)
 
-    url = f"https://update.code.visualstudio.com/{revision}/linux-deb-x64/{channel}"
-    r = requests.get(url, allow_redirects=False)
-    if r.status_code != 302:
-        logging.error(f"cannot get {channel} channel")
-        return
+    return True
 
-    url = r.headers["Location"]
-    path = urllib.parse.urlsplit(url).path.split("/")
-    if len(path) != 4:
-        logging.error(f"cannot parse url {url}")
-        return
 
-    commit_id = path[2]
-    deb_filename = path[3]
-    package = "code"
-    filename = dst_dir / "code" / commit_id / deb_filename
-    tag = re.search(r"_(.+)_", deb_filename).group(1)
-    version = tag.split("-", 1)[0]
+def tree_name(vsix):
+    """
+    return the name of the extracted tree of a vsix, in the web root
+    """
+    return f"{TREE_DIR}/{pathlib.PurePosixPath(vsix).stem}"
 
-    if filename.is_file():
-        print("{:50} {:20} {}".format(package, tag, CHECK_MARK))
-    else:
-        print("{:50} {:20} {} downloading...".format(package, tag, HEAVY_BALLOT_X))
-        download(url, filename)
 
-        d = filename.parent.parent / revision
-        if d.is_symlink():
-            d.unlink()
-        d.symlink_to(commit_id, target_is_directory=True)
+def extract_extension(dst_dir, vsix, inventory=None):
+    """
+    publish the content of a vsix as the directory Code installs, with the
+    manifest of its files: clients copy it instead of installing the vsix
+    return the name of the tree
+    """
 
-        d = filename.parent.parent / version
-        if d.is_symlink():
-            d.unlink()
-        d.symlink_to(commit_id, target_is_directory=True)
+    import zipfile
 
-    data = {}
-    data["version"] = version
-    data["tag"] = tag
-    data["channel"] = channel
-    data["commit_id"] = commit_id
-    data["url"] = str(filename.relative_to(dst_dir))
-    data["deb"] = deb_filename
-    data["server"] = []
+    storage = get_storage()
+    tree = tree_name(vsix)
+    if storage.exists(dst_dir / (tree + ".json")):
+        return tree
 
-    for arch in ["x64", "armhf", "alpine", "arm64"]:
-        package = f"server-linux-{arch}"
-        url = f"https://update.code.visualstudio.com/commit:{commit_id}/{package}/{channel}"
-        r = requests.get(url, allow_redirects=False)
-        if r.status_code == 302:
-            url = r.headers["Location"]
-            path = urllib.parse.urlsplit(url).path.split("/")
-            if len(path) != 4:
+    files = {}
+    with storage.open_read(dst_dir / vsix) as f, zipfile.ZipFile(f) as z:
+        package = json.loads(z.read("extension/package.json"))
+        vsixmanifest = z.read("extension.vsixmanifest").decode(errors="replace")
+        for info in z.infolist():
+            if info.is_dir() or not info.filename.startswith("extension/"):
                 continue
-            filename = dst_dir / "code" / commit_id / path[3]
-            data["server"].append(path[3])
-
-            if filename.is_file():
-                print("{:50} {:20} {}".format(package, version, CHECK_MARK))
-            else:
-                print(
-                    "{:50} {:20} {} downloading...".format(
-                        package, version, HEAVY_BALLOT_X
-                    )
-                )
-                download(url, filename)
+            name = info.filename[len("extension/") :]
+            path = pathlib.PurePosixPath(name)
+            if path.is_absolute() or ".." in path.parts:
+                continue
+            content = z.read(info)
+            storage.write_bytes(dst_dir / tree / name, content)
+            files[name] = [len(content), hashlib.sha256(content).hexdigest()]
+            if inventory is not None:
+                inventory.stat(f"{tree}/{name}")
+
+    # name of the directory in ~/.vscode/extensions
+    ext_id = f"{package['publisher']}.{package['name']}".lower()
+    directory = f"{ext_id}-{package['version']}"
+    platform = re.search(r'TargetPlatform="([^"]+)"', vsixmanifest)
+    if platform:
+        directory += "-" + platform.group(1)
+
+    manifest = {
+        "id": ext_id,
+        "version": package["version"],
+        "targetPlatform": platform.group(1) if platform else None,
+        "directory": directory,
+        "files": files,
+    }
+    # the manifest is written last: the tree is complete once it exists
+    storage.write_bytes(dst_dir / (tree + ".json"), json.dumps(manifest).encode())
+    if inventory is not None:
+        inventory.stat(tree + ".json")
+    return tree
 
-    return data
 
+async def run_stage(inbox, outbox, workers, handler):
+    """
+    run `workers` concurrent handlers on the items of a queue
+    None is the end of stream marker: it is put back for the other workers,
+    then forwarded to the next stage
+    """
 
-def purge(path, keep):
+    import asyncio
+
+    async def worker():
+        while True:
+            item = await inbox.get()
+            if item is None:
+                await inbox.put(None)
+                break
+            try:
+                result = await handler(item)
+            except Exception as e:
+                logging.error("%s: %r", item[0], e)
+                continue
+            if outbox is not None and result is not None:
+                await outbox.put(result)
+
+    await asyncio.gather(*(worker() for _ in range(workers)))
+    if outbox is not None:
+        await outbox.put(None)
+
+
+async def sync_pipeline(
+    loop,
+    executor,
+    dst_dir,
+    extensions,
+    json_data,
+    engine_version,
+    args,
+    code_jobs,
+    previous,
+    inventory,
+):
     """
-    keep only `keep` old versions
-    return the list of files removed
+    stream the gallery results into the download stage, the downloads into
+    the verification stage, and the verified items into the catalog
+    stages are connected by bounded queues, blocking I/O runs into the executor
     """
 
-    if re.match("vsix", path):
-        pattern = re.compile(r"^([\w\-]+\.[\w\-]+)\-(\d+\.\d+\.\d+)\.vsix$")
-    else:
-        pattern = re.compile(r"^([\w\-]+)_(\d+\.\d+\.\d+\-\d+)_amd64\.deb$")
+    import asyncio
 
-    files = defaultdict(lambda: [])
-    for f in pathlib.Path(path).glob("**/*"):
-        g = re.match(pattern, f.name)
-        if not g:
-            logging.warn("not matching RE: %s", f)
-        else:
-            version = list(map(int, re.split("[.-]", g.group(2))))
-            files[g.group(1)].append((f, version))
+    downloads = asyncio.Queue(QUEUE_SIZE)
+    checks = asyncio.Queue(QUEUE_SIZE)
+    records = asyncio.Queue(QUEUE_SIZE)
 
-    unlink = []
-    for k, e in files.items():
-        n = max(keep, 0) + 1
-        for f, v in sorted(e, key=itemgetter(1), reverse=True):
-            if n == 0:
-                # print("UNLINK", k, v)
-                unlink.append(f)
-            else:
-                # print("KEEP  ", k, v)
-                n -= 1
+    def run(func, *a):
+        return loop.run_in_executor(executor, func, *a)
 
-    for f in unlink:
-        logging.debug("unlink %s", f)
-        f.unlink()
+    async def query():
+        # Code packages are the largest artifacts: start them first
+        for key, fetch, path in code_jobs:
+            check = partial(check_artifact, dst_dir, path, inventory)
+            await downloads.put((key, fetch, check))
 
-    return unlink
+        response = resolve_extensions(
+            extensions,
+            engine_version,
+            not args.no_dependencies,
+            dst_dir,
+            args.config.queries,
+            args.shard,
+        )
+        while True:
+            e = await run(next, response, None)
+            if e is None:
+                break
+
+            key = e["publisher"]["publisherName"] + "." + e["extensionName"]
+            if key == CPPTOOLS_KEY:
+                keys = await run(process_cpptools, dst_dir, json_data, e)
+            else:
+                json_data["extensions"][key] = extension_data(e)
+                keys = [key]
+
+            for key in keys:
+                data = json_data["extensions"][key]
+                if is_unchanged(key, data, previous, inventory, args.extract):
+                    if args.extract:
+                        data["tree"] = previous["extensions"][key]["tree"]
+                    if key == "golang.Go" and "go-tools" in previous:
+                        json_data["go-tools"] = previous["go-tools"]
+                        if "go-proxy" in previous:
+                            json_data["go-proxy"] = previous["go-proxy"]
+                    continue
+                fetch = partial(fetch_extension, dst_dir, key, data, args.dry_run)
+                check = partial(
+                    check_extension,
+                    dst_dir,
+                    key,
+                    data,
+                    json_data,
+                    args.dry_run,
+                    args.no_golang,
+                    inventory,
+                    args.extract,
+                )
+                await downloads.put((key, fetch, check))
+
+        await downloads.put(None)
+
+    async def fetch(item):
+        key, fetch, check = item
+        await run(fetch)
+        return item
+
+    async def validate(item):
+        key, fetch, check = item
+        if check is None or await run(check):
+            return item
+        # the corrupted artifact has been quarantined: download it again, once
+        logging.warning("downloading %s again", key)
+        await run(fetch)
+        if await run(check):
+            return item
+        if key in json_data["extensions"]:
+            # the catalog must not list the quarantined artifact
+            revert_extension(key, json_data, previous, inventory)
+
+    async def catalog(item):
+        key = item[0]
+        data = json_data["extensions"].get(key)
+        if data is not None:
+            if inventory is not None:
+                inventory.stat(data["vsix"])
+                inventory.stat(data["icon"])
+            events.emit("catalog_record", key=key, version=data["version"])
+
+    tasks = [
+        asyncio.ensure_future(query()),
+        asyncio.ensure_future(run_stage(downloads, checks, args.jobs, fetch)),
+        asyncio.ensure_future(run_stage(checks, records, args.jobs, validate)),
+        asyncio.ensure_future(run_stage(records, None, 1, catalog)),
+    ]
+    try:
+        await asyncio.gather(*tasks)
+    finally:
+        # a failed stage stops the other ones, the loop is closed afterwards
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
 
 
-def download_assets(destination):
+def revert_extension(key, json_data, previous, inventory):
     """
-    download assets (css, images, javascript)
+    list the previous version of a corrupted extension in the catalog, or
+    remove the extension if that version is not in the mirror
+    """
+
+    old = previous["extensions"].get(key) if previous is not None else None
+    if old is not None and inventory is not None and old["vsix"] in inventory:
+        logging.error("%s is corrupted, version %s kept", key, old["version"])
+        json_data["extensions"][key] = old
+    else:
+        logging.error("%s is corrupted, removed from the catalog", key)
+        del json_data["extensions"][key]
+
+
+def is_unchanged(key, data, previous, inventory, extract=False):
+    """
+    tell if an extension has not changed since the previous sync
+    """
+
+    if previous is None or inventory is None:
+        return False
+    old = previous["extensions"].get(key)
+    return (
+        old is not None
+        and old["version"] == data["version"]
+        and data["vsix"] in inventory
+        and data["icon"] in inventory
+        and (not extract or "tree" in old)
+    )
+
+
+def dl_extensions(
+    dst_dir,
+    extensions,
+    json_data,
+    engine_version,
+    args,
+    code_jobs=(),
+    previous=None,
+    inventory=None,
+):
+    """
+    download or update extensions
+    with a previous catalog and an inventory, only the changes are processed
+    """
+
+    import asyncio
+    from concurrent.futures import ThreadPoolExecutor
+
+    loop = asyncio.new_event_loop()
+    # one more thread for the gallery query, one for the verification stage
+    executor = ThreadPoolExecutor(max_workers=args.jobs * 2 + 1)
+    try:
+        loop.run_until_complete(
+            sync_pipeline(
+                loop,
+                executor,
+                dst_dir,
+                extensions,
+                json_data,
+                engine_version,
+                args,
+                code_jobs,
+                previous,
+                inventory,
+            )
+        )
+    finally:
+        executor.shutdown()
+        loop.close()
+
+    events.phase_done("extensions")
+
+
+def write_catalog(dst_dir, json_data):
+    """
+    write the markdown catalog file
+    """
+
+    lines = []
+
+    md = ["Icon", "Name", "Description", "Author", "Version", "Date"]
+
+    lines.append("|".join(md))
+    lines.append("|".join(["-" * len(i) for i in md]))
+
+    for key, data in sorted(json_data["extensions"].items()):
+
+        def new_row(data):
+            md[0] = "![{name}]({icon})".format_map(data)
+            md[1] = "[{name}]({url})".format_map(data)
+            md[2] = data["description"]
+            md[3] = "[{author}]({authorUrl})".format_map(data)
+            md[4] = "[{version}]({vsix})".format_map(data)
+            md[5] = data["lastUpdated"]
+
+            lines.append("|".join(md))
+
+        new_row(data)
+
+    text = "".join(line + "\n" for line in lines)
+    get_storage().write_bytes(dst_dir / "extensions.md", text.encode())
+
+    write_catalog_pages(dst_dir, json_data)
+
+    events.phase_done("catalog")
+
+
+def tokenize(*texts):
+    """
+    return the search tokens of texts
+    """
+    return {
+        token
+        for text in texts
+        for token in re.findall(r"[a-z0-9]+", (text or "").lower())
+        if len(token) > 1
+    }
+
+
+def write_catalog_pages(dst_dir, json_data):
+    """
+    write the catalog for index.html: a search index and pages of extensions,
+    so that the page shows the first extensions without loading everything
+    """
+
+    storage = get_storage()
+    catalog = dst_dir / CATALOG_DIR
+
+    fields = ["name", "url", "description", "author", "authorUrl", "version"]
+    fields += ["vsix", "icon", "lastUpdated"]
+    rows = []
+    tokens = defaultdict(list)
+    for number, (key, data) in enumerate(sorted(json_data["extensions"].items())):
+        rows.append(dict({field: data.get(field) for field in fields}, key=key))
+        for token in sorted(
+            tokenize(key, data["name"], data["description"], data["author"])
+        ):
+            tokens[token].append(number)
+
+    pages = [
+        rows[i : i + CATALOG_PAGE_SIZE] for i in range(0, len(rows), CATALOG_PAGE_SIZE)
+    ]
+    for number, page in enumerate(pages, 1):
+        data = json.dumps(page, separators=(",", ":"))
+        storage.write_bytes(catalog / f"page-{number:04}.json", data.encode())
+
+    code = json_data.get("code") or {}
+    index = {
+        "generation": json_data.get("generation"),
+        "code": {k: code.get(k) for k in ("version", "url", "deb")},
+        "count": len(rows),
+        "pageSize": CATALOG_PAGE_SIZE,
+        "pages": len(pages),
+        "tokens": dict(sorted(tokens.items())),
+    }
+    # the index is written last: it refers to the pages
+    data = json.dumps(index, separators=(",", ":"))
+    storage.write_bytes(catalog / "index.json", data.encode())
+
+    # the pages of a longer catalog
+    for name in storage.list(catalog):
+        m = re.search(r"/page-(\d+)\.json$", name)
+        if m and int(m.group(1)) > len(pages):
+            storage.delete(dst_dir / name)
+
+
+def resolve_code(dst_dir, channel="stable", revision="latest", queue=True):
+    """
+    find Code for Linux from Microsoft debian-like repo
+    return the catalog data and the list of downloads to do
+    without `queue`, only the version is resolved: nothing is queued
+    """
+
+    jobs = []
+
+    url = f"https://update.code.visualstudio.com/{revision}/linux-deb-x64/{channel}"
+    r = get_session().get(url, allow_redirects=False)
+    if r.status_code != 302:
+        logging.error(f"cannot get {channel} channel")
+        return {}, jobs
+
+    url = r.headers["Location"]
+    path = urllib.parse.urlsplit(url).path.split("/")
+    if len(path) != 4:
+        logging.error(f"cannot parse url {url}")
+        return {}, jobs
+
+    commit_id = path[2]
+    deb_filename = path[3]
+    package = "code"
+    filename = dst_dir / "code" / commit_id / deb_filename
+    tag = re.search(r"_(.+)_", deb_filename).group(1)
+    version = tag.split("-", 1)[0]
+
+    if not queue:
+        return {"version": version, "tag": tag, "commit_id": commit_id}, jobs
+
+    if get_storage().exists(filename):
+        print("{:50} {:20} {}".format(package, tag, CHECK_MARK))
+    else:
+        print("{:50} {:20} {} downloading...".format(package, tag, HEAVY_BALLOT_X))
+        events.artifact_queued(package, url, filename.relative_to(dst_dir))
+        jobs.append(
+            (
+                package,
+                partial(fetch_code, url, filename, commit_id, [revision, version]),
+                filename.relative_to(dst_dir).as_posix(),
+            )
+        )
+
+    data = {}
+    data["version"] = version
+    data["tag"] = tag
+    data["channel"] = channel
+    data["commit_id"] = commit_id
+    data["url"] = str(filename.relative_to(dst_dir))
+    data["deb"] = deb_filename
+    data["server"] = []
+
+    for arch in ["x64", "armhf", "alpine", "arm64"]:
+        package = f"server-linux-{arch}"
+        url = f"https://update.code.visualstudio.com/commit:{commit_id}/{package}/{channel}"
+        r = get_session().get(url, allow_redirects=False)
+        if r.status_code == 302:
+            url = r.headers["Location"]
+            path = urllib.parse.urlsplit(url).path.split("/")
+            if len(path) != 4:
+                continue
+            filename = dst_dir / "code" / commit_id / path[3]
+            data["server"].append(path[3])
+
+            if get_storage().exists(filename):
+                print("{:50} {:20} {}".format(package, version, CHECK_MARK))
+            else:
+                print(
+                    "{:50} {:20} {} downloading...".format(
+                        package, version, HEAVY_BALLOT_X
+                    )
+                )
+                events.artifact_queued(package, url, filename.relative_to(dst_dir))
+                jobs.append(
+                    (
+                        package,
+                        partial(download, url, filename, package),
+                        filename.relative_to(dst_dir).as_posix(),
+                    )
+                )
+
+    return data, jobs
+
+
+def fetch_code(url, filename, commit_id, aliases):
+    """
+    download the Code package and link the aliases to its commit directory
+    """
+
+    download(url, filename, "code")
+
+    for alias in aliases:
+        get_storage().symlink(filename.parent.parent / alias, commit_id)
+
+
+def dl_code(dst_dir, channel="stable", revision="latest"):
+    """
+    download code for Linux from Microsoft debian-like repo
+    """
+
+    data, jobs = resolve_code(dst_dir, channel, revision)
+    for _, fetch, _ in jobs:
+        fetch()
+
+    events.phase_done("code")
+    return data
+
+
+def purge(args, inventory, json_data=None):
+    """
+    apply the retention policy to the old versions of Code and extensions
+    return the list of files removed, relative to the web root, and the
+    number of bytes freed
+    """
+
+    storage = get_storage()
+    root = pathlib.Path(args.root)
+
+    patterns = {
+        "code": re.compile(r"^([\w\-]+)_(\d+\.\d+\.\d+\-\d+)_amd64\.deb$"),
+        "vsix": re.compile(r"^([\w\-]+\.[\w\-]+)\-(\d+\.\d+\.\d+)\.vsix$"),
+    }
+
+    # the versions of the catalog are never removed
+    current = set()
+    if json_data is not None:
+        if json_data.get("code"):
+            code_dir = pathlib.PurePosixPath(json_data["code"]["url"]).parent
+            current.add(json_data["code"]["url"])
+            current.update(
+                (code_dir / server).as_posix()
+                for server in json_data["code"].get("server", [])
+            )
+        current.update(data["vsix"] for data in json_data["extensions"].values())
+
+    # the extensions wanted by the team are removed last
+    try:
+        team = set(key.lower() for key in json.loads(storage.read_bytes("team.json")))
+    except (OSError, ValueError, TypeError, AttributeError):
+        team = set()
+
+    if args.access_log:
+        for name, accessed in retention.read_access_log(args.access_log).items():
+            entry = inventory.get(name)
+            if entry is not None and accessed > entry.get("accessed", 0):
+                entry["accessed"] = accessed
+
+    # size of the extracted trees: they are removed with their vsix
+    tree_sizes = defaultdict(int)
+    for name, entry in inventory.files.items():
+        if name.startswith(TREE_DIR + "/"):
+            tree = name.split("/", 2)[1]
+            if tree.endswith(".json"):
+                # the manifest of the tree
+                tree = tree[: -len(".json")]
+            tree_sizes[tree] += entry.get("size", 0)
+
+    artifacts = []
+    servers = []
+
+    def add_artifact(name, key, version):
+        entry = inventory.get(name) or {}
+        if name.startswith("vsix/"):
+            size = tree_sizes[pathlib.PurePosixPath(name).stem]
+        else:
+            size = 0
+        artifacts.append(
+            {
+                "name": name,
+                "key": key,
+                "version": version,
+                "size": entry.get("size", 0) + size,
+                "accessed": entry.get("accessed"),
+                "current": name in current,
+                "team": key.lower() in team,
+            }
+        )
+
+    for d, pattern in patterns.items():
+        for f in storage.list(root / d):
+            if inventory.stat(f) is None:
+                # a symbolic link of the object storage
+                continue
+            filename = pathlib.PurePosixPath(f).name
+            if filename.startswith("vscode-server-linux-"):
+                servers.append(f)
+                continue
+            g = re.match(pattern, filename)
+            if not g:
+                logging.warning("not matching RE: %s", f)
+                continue
+            add_artifact(f, g.group(1), list(map(int, re.split("[.-]", g.group(2)))))
+
+    # the remote servers have the version of the Code package of their commit
+    code_versions = {
+        pathlib.PurePosixPath(a["name"]).parent: a["version"]
+        for a in artifacts
+        if a["name"].startswith("code/")
+    }
+    for f in servers:
+        path = pathlib.PurePosixPath(f)
+        version = code_versions.get(path.parent)
+        if version is None:
+            logging.warning("no Code package for %s", f)
+            continue
+        add_artifact(f, path.name.split(".", 1)[0], version)
+
+    total = sum(entry["size"] for entry in inventory.files.values())
+    recent = args.keep_accessed * 86400 if args.keep_accessed is not None else None
+    keep = args.keep if args.keep is not None else 0
+
+    unlink = []
+    freed = 0
+    for artifact in retention.select(
+        artifacts, keep, args.quota, total, recent, time.time()
+    ):
+        logging.debug("unlink %s", artifact["name"])
+        storage.delete(artifact["name"])
+        inventory.remove(artifact["name"])
+        unlink.append(artifact["name"])
+        freed += artifact["size"]
+
+        if artifact["name"].startswith("vsix/"):
+            # the extracted tree of the version
+            tree = tree_name(artifact["name"])
+            # its size is counted in the size of the artifact
+            for name in list(storage.list(root / tree)) + [tree + ".json"]:
+                storage.delete(root / name)
+                inventory.remove(name)
+
+    return unlink, freed
+
+
+def write_tool_version(dst_dir):
+    """
+    write the version descriptor of the companion tool, that code-tool checks
+    before downloading itself
+    """
+
+    code = resource_path("get.py").read_bytes()
+    version = re.search(rb"\nTOOL_VERSION = (\d+)", code)
+    descriptor = {
+        "version": int(version.group(1)),
+        "sha256": hashlib.sha256(code).hexdigest(),
+    }
+    data = json.dumps(descriptor).encode()
+
+    # unchanged: the clients keep on getting 304 answers
+    storage = get_storage()
+    try:
+        if storage.read_bytes(dst_dir / "get.json") == data:
+            return
+    except OSError:
+        pass
+    storage.write_bytes(dst_dir / "get.json", data)
+
+
+def download_assets(destination):
+    """
+    download assets (css, images, javascript)
     """
 
     dst_dir = pathlib.Path(destination)
@@ -732,100 +1713,181 @@ def download_assets(destination):
     #     shutil.copy2(src_dir / "get.py", dst_dir)
     #     (dst_dir / "get.py").chmod(0o755)
 
-    shutil.copy2(pkg_resources.resource_filename(__name__, "index.html"), dst_dir)
-    shutil.copy2(pkg_resources.resource_filename(__name__, "get.py"), dst_dir)
-    (dst_dir / "get.py").chmod(0o755)
-
-    if (dst_dir / "team.json").exists() is False:
-        with (dst_dir / "team.json").open("w") as fd:
-            fd.write("[]")
+    storage = get_storage()
+    storage.upload_file(str(resource_path("index.html")), dst_dir / "index.html")
+    storage.upload_file(str(resource_path("get.py")), dst_dir / "get.py", mode=0o755)
+    write_tool_version(dst_dir)
 
-    os.chdir(dst_dir)
+    if not storage.exists(dst_dir / "team.json"):
+        storage.write_bytes(dst_dir / "team.json", b"[]")
 
     # markdown-it
     download(
         "https://cdnjs.cloudflare.com/ajax/libs/markdown-it/8.4.1/markdown-it.min.js",
-        "markdown-it.min.js",
+        dst_dir / "markdown-it.min.js",
     )
     download(
         "https://cdnjs.cloudflare.com/ajax/libs/highlight.js/9.12.0/highlight.min.js",
-        "highlight.min.js",
+        dst_dir / "highlight.min.js",
     )
     download(
         "https://cdnjs.cloudflare.com/ajax/libs/highlight.js/9.12.0/styles/vs2015.min.css",
-        "vs2015.min.css",
+        dst_dir / "vs2015.min.css",
     )
 
     # Mou/MacDown GitHub like stylesheet
     download(
         "https://raw.githubusercontent.com/gcollazo/mou-theme-github2/master/GitHub2.css",
-        "GitHub2.css",
+        dst_dir / "GitHub2.css",
     )
 
     # images from VSCode homepage
     download(
         "https://code.visualstudio.com/assets/images/home-debug.svg",
-        "images/home-debug.svg",
+        dst_dir / "images/home-debug.svg",
     )
     download(
         "https://code.visualstudio.com/assets/images/home-git.svg",
-        "images/home-git.svg",
+        dst_dir / "images/home-git.svg",
     )
     download(
         "https://code.visualstudio.com/assets/images/home-intellisense.svg",
-        "images/home-intellisense.svg",
+        dst_dir / "images/home-intellisense.svg",
     )
     download(
         "https://code.visualstudio.com/assets/images/Hundreds-of-Extensions.png",
-        "images/Hundreds-of-Extensions.png",
+        dst_dir / "images/Hundreds-of-Extensions.png",
     )
 
     # VSCode icon as favicon
     download(
         "https://github.com/Microsoft/vscode/raw/master/resources/win32/code.ico",
-        "favicon.ico",
+        dst_dir / "favicon.ico",
     )
 
 
-def print_conf(args):
+def read_extensions_dir(path):
     """
-    print the configuration as a YAML file
+    return the id@version of the extensions installed into a directory, from
+    its manifest (extensions.json) or from the manifests of the extensions
+    return None if the layout is not recognized
+    """
+
+    # copy of read_extensions_dir() in get.py, that cannot be imported here
+    # (it imports requests eagerly): keep both functions in sync
+
+    try:
+        obsolete = set(json.loads((path / ".obsolete").read_text()))
+    except (OSError, ValueError):
+        obsolete = set()
+
+    installed = set()
+
+    try:
+        for e in json.loads((path / "extensions.json").read_text()):
+            if e.get("relativeLocation") in obsolete:
+                continue
+            installed.add(e["identifier"]["id"] + "@" + e["version"])
+        return installed
+    except OSError:
+        pass
+    except (ValueError, KeyError, TypeError) as e:
+        logging.debug(f"unexpected extensions.json in {path}: {e!r}")
+        return None
+
+    # older versions of Code: no manifest
+    for d in path.iterdir():
+        if d.name in obsolete or d.name.startswith("."):
+            continue
+        try:
+            manifest = json.loads((d / "package.json").read_text(encoding="utf-8"))
+            installed.add(
+                f"{manifest['publisher']}.{manifest['name']}@{manifest['version']}"
+            )
+        except NotADirectoryError:
+            continue
+        except (OSError, ValueError, KeyError) as e:
+            logging.debug(f"unexpected extension {d}: {e!r}")
+            return None
+    return installed
+
+
+def get_installed_extensions():
+    """
+    return the identifiers of the installed extensions
+    the extensions directories are read directly, code is run only if their
+    layout is unknown
     """
 
+    installed = set()
+    found = False
+    for path in EXTENSIONS_DIRS:
+        path = pathlib.Path(path).expanduser()
+        if not path.is_dir():
+            continue
+        extensions = read_extensions_dir(path)
+        if extensions is None:
+            found = False
+            break
+        installed.update(e.partition("@")[0] for e in extensions)
+        found = True
+
+    if found:
+        return installed
+
     try:
         s = subprocess.check_output(
             "code --list-extensions", shell=True, stderr=subprocess.DEVNULL
         )
-        installed = set(s.decode().split())
+        return set(s.decode().split())
     except subprocess.CalledProcessError:
-        installed = set()
+        return set()
+
+
+def print_conf(args):
+    """
+    print the configuration as a YAML file
+    """
+
+    import yaml
+
+    installed = get_installed_extensions()
+
+    conf = dict(args.config.raw)
+    listed = set(args.config.extensions)
 
-    listed = set()
-    if os.path.exists(args.conf):
-        conf = yaml.load(open(args.conf), Loader=yaml.BaseLoader)
-        if "extensions" in conf:
-            listed = set(conf["extensions"])
+    # the identifiers of the extensions are case insensitive
+    lowered = {key.lower() for key in listed}
+    installed_lowered = {key.lower() for key in installed}
 
-    conf["installed"] = list(installed)
-    conf["not-installed"] = list(listed - installed)
-    conf["not-listed"] = list(installed - listed)
+    conf["installed"] = sorted(installed)
+    conf["not-installed"] = sorted(
+        key for key in listed if key.lower() not in installed_lowered
+    )
+    conf["not-listed"] = sorted(key for key in installed if key.lower() not in lowered)
 
     # sys.stdout.write("\033[1;36m")
     yaml.dump(conf, stream=sys.stdout, default_flow_style=False)
     # sys.stdout.write("\033[0m\n")
 
 
-def download_code_vsix(args):
+def download_code_vsix(args, previous=None, inventory=None):
     """
     the real thing is here
+    return the catalog, or None if nothing has changed since `previous`
     """
 
     json_data = {"code": {}, "extensions": {}}
     dst_dir = pathlib.Path(args.root)
+    code_jobs = []
+
+    # Code is downloaded by the first shard, the other ones only need its
+    # version for the engine of the extensions
+    first = not args.shard or args.shard[0] == 1
 
-    # download VSCode
+    # find VSCode: its packages are downloaded by the extensions pipeline
     if not args.no_code:
-        json_data["code"] = dl_code(dst_dir)
+        json_data["code"], code_jobs = resolve_code(dst_dir, queue=first)
 
     # set the engine version (computed value from vscode version...)
     if args.engine:
@@ -848,24 +1910,318 @@ def download_code_vsix(args):
     logging.debug("using Code engine version: %s", engine_version)
 
     # prepare the extension list
-    extensions = list()
+    extensions = list(set(args.config.extensions))
 
-    # get the listed extensions
-    if os.path.exists(args.conf):
-        conf = yaml.load(open(args.conf), Loader=yaml.BaseLoader)
-        if "extensions" in conf:
-            listed = set(conf["extensions"])
-            extensions = list(listed.union(extensions))
-        conf = None
+    if args.shard:
+        extensions = [ext for ext in extensions if in_shard(ext, args.shard)]
+        logging.info("shard %d/%d: %d extensions", *args.shard, len(extensions))
+        if not first:
+            json_data["code"] = {}
 
-    # download extensions
+    # download Code and extensions
     dl_extensions(
-        dst_dir, extensions, json_data, engine_version, args.dry_run, args.no_golang
+        dst_dir,
+        extensions,
+        json_data,
+        engine_version,
+        args,
+        code_jobs,
+        previous,
+        inventory,
     )
 
-    # write the JSON data file
-    with open(dst_dir / "data.json", "w") as f:
-        json.dump(json_data, f, indent=4)
+    if inventory is not None:
+        for path in artifact_paths(json_data):
+            inventory.stat(path)
+        if json_data.get("go-proxy"):
+            for path in get_storage().list(dst_dir / json_data["go-proxy"]):
+                inventory.stat(path)
+        add_checksums(json_data, inventory)
+
+    # the generation number alone is not a change
+    if previous is not None and json_data == {
+        k: v for k, v in previous.items() if k != "generation"
+    }:
+        return None
+
+    if args.shard:
+        write_fragment(dst_dir, args.shard, json_data, inventory)
+    else:
+        if inventory is not None:
+            json_data["generation"] = inventory.generation + 1
+        write_data(dst_dir, json_data)
+
+    return json_data
+
+
+def write_data(dst_dir, json_data):
+    """
+    write the JSON data file, the changes feed and the markdown catalog
+    """
+
+    storage = get_storage()
+    try:
+        previous = json.loads(storage.read_bytes(dst_dir / "data.json"))
+    except (OSError, ValueError):
+        previous = None
+
+    data = json.dumps(json_data, indent=4)
+    storage.write_bytes(dst_dir / "data.json", data.encode())
+    if "generation" in json_data:
+        write_changes(dst_dir, previous, json_data)
+    write_catalog(dst_dir, json_data)
+
+
+def diff_catalogs(previous, json_data):
+    """
+    return the changes between two catalogs: the new values of the modified
+    entries, None for the removed ones
+    """
+
+    entry = {"generation": json_data["generation"], "extensions": {}}
+    for key in set(previous) | set(json_data):
+        if key not in ("generation", "extensions"):
+            if previous.get(key) != json_data.get(key):
+                entry[key] = json_data.get(key)
+
+    old, new = previous["extensions"], json_data["extensions"]
+    for key in sorted(set(old) | set(new)):
+        if old.get(key) != new.get(key):
+            entry["extensions"][key] = new.get(key)
+    return entry
+
+
+def write_changes(dst_dir, previous, json_data):
+    """
+    add the changes of a generation to the changes feed, that lets the clients
+    update their copy of the catalog
+    the feed covers the generations after `since`
+    """
+
+    storage = get_storage()
+    generation = json_data["generation"]
+    try:
+        changes = json.loads(storage.read_bytes(dst_dir / "changes.json"))
+    except (OSError, ValueError):
+        changes = None
+
+    if previous is None or "generation" not in previous:
+        # no previous catalog: the feed starts now
+        changes = {"generation": generation, "since": generation, "entries": []}
+    else:
+        if changes is None or changes["generation"] != previous["generation"]:
+            changes = {"since": previous["generation"], "entries": []}
+        changes["generation"] = generation
+        entry = diff_catalogs(previous, json_data)
+        entries = changes["entries"]
+        if entries and entries[-1]["generation"] == generation:
+            # the generation is written again (interrupted sync)
+            entries[-1]["extensions"].update(entry.pop("extensions"))
+            entries[-1].update(entry)
+        else:
+            entries.append(entry)
+
+    del changes["entries"][:-CHANGES_KEPT]
+    if changes["entries"]:
+        changes["since"] = max(
+            changes["since"], changes["entries"][0]["generation"] - 1
+        )
+
+    data = json.dumps(changes, indent=1)
+    storage.write_bytes(dst_dir / "changes.json", data.encode())
+
+
+def artifact_paths(json_data):
+    """
+    return the paths of the artifacts listed in a catalog
+    """
+
+    paths = []
+    if json_data.get("code"):
+        code_dir = pathlib.PurePosixPath(json_data["code"]["url"]).parent
+        paths.append(json_data["code"]["url"])
+        paths.extend(
+            (code_dir / server).as_posix() for server in json_data["code"]["server"]
+        )
+    for data in json_data["extensions"].values():
+        paths.append(data["vsix"])
+        paths.append(data["icon"])
+    return paths
+
+
+def add_checksums(json_data, inventory):
+    """
+    add the SHA-256 of the packages to the catalog, for the client cache
+    """
+
+    if json_data.get("code"):
+        sha256 = inventory.checksum(json_data["code"]["url"])
+        if sha256 is not None:
+            json_data["code"]["sha256"] = sha256
+    for data in json_data["extensions"].values():
+        sha256 = inventory.checksum(data["vsix"])
+        if sha256 is not None:
+            data["sha256"] = sha256
+
+
+def parse_shard(value):
+    """
+    parse the --shard option: i/N with 1 <= i <= N
+    """
+
+    m = re.fullmatch(r"(\d+)/(\d+)", value)
+    if m is None or not 1 <= int(m.group(1)) <= int(m.group(2)):
+        raise argparse.ArgumentTypeError("expected i/N with 1 <= i <= N")
+    return int(m.group(1)), int(m.group(2))
+
+
+def parse_jobs(value):
+    """
+    parse the --jobs option: a positive number
+    """
+
+    if not value.isdigit() or int(value) < 1:
+        raise argparse.ArgumentTypeError("expected a number >= 1")
+    return int(value)
+
+
+def parse_size(value):
+    """
+    parse the --quota option: a size in bytes, or with a K, M, G or T suffix
+    """
+
+    m = re.fullmatch(r"(\d+(?:\.\d+)?)\s*([KMGT]?)(?:i?B)?", value.strip(), re.I)
+    if m is None:
+        raise argparse.ArgumentTypeError("expected a size like 500M or 200G")
+    return int(float(m.group(1)) * 1024 ** " KMGT".index(m.group(2).upper() or " "))
+
+
+def format_size(size):
+    """
+    return a human readable size
+    """
+
+    for unit in ["B", "KiB", "MiB", "GiB"]:
+        if size < 1024:
+            return f"{size:.1f} {unit}" if unit != "B" else f"{size} B"
+        size /= 1024
+    return f"{size:.1f} TiB"
+
+
+def in_shard(key, shard):
+    """
+    tell if an extension belongs to a shard
+    the partition only depends on the extension name
+    """
+
+    index, count = shard
+    digest = hashlib.sha1(key.lower().encode()).digest()
+    return int.from_bytes(digest[:8], "big") % count == index - 1
+
+
+def fragment_path(dst_dir, shard):
+    return dst_dir / "shards" / "data-{}-of-{}.json".format(*shard)
+
+
+def write_fragment(dst_dir, shard, json_data, inventory=None):
+    """
+    write the partial catalog and inventory of a shard
+    """
+
+    if inventory is None:
+        inventory = Inventory(dst_dir, get_storage())
+        inventory.load()
+
+    files = {}
+    for path in artifact_paths(json_data):
+        entry = inventory.stat(path)
+        if entry is not None:
+            files[path] = entry
+
+    fragment = fragment_path(dst_dir, shard)
+    data = json.dumps({"shard": shard, "data": json_data, "inventory": files}, indent=4)
+    get_storage().write_bytes(fragment, data.encode())
+    logging.info("shard %d/%d written into %s", *shard, fragment)
+
+
+def merge(args):
+    """
+    merge the shard fragments into one consistent mirror
+    the artifacts of every shard should have been copied into the web root
+    """
+
+    storage = get_storage()
+    root = pathlib.Path(args.root)
+
+    fragments = []
+    for name in sorted(storage.list(root / "shards")):
+        if re.fullmatch(r"data-\d+-of-\d+\.json", pathlib.PurePosixPath(name).name):
+            fragments.append(json.loads(storage.read_bytes(name)))
+
+    counts = set(fragment["shard"][1] for fragment in fragments)
+    if len(counts) != 1:
+        logging.error("no fragment or fragments of different shardings: %s", counts)
+        exit(2)
+    count = counts.pop()
+    missing = set(range(1, count + 1)) - set(f["shard"][0] for f in fragments)
+    if missing:
+        logging.error("missing shards: %s", " ".join(map(str, sorted(missing))))
+        exit(2)
+
+    json_data = {"code": {}, "extensions": {}}
+    inventory = Inventory(root, storage)
+    inventory.load()
+
+    for fragment in sorted(fragments, key=lambda f: f["shard"][0]):
+        data = fragment["data"]
+        if data.get("code"):
+            json_data["code"] = data["code"]
+        if "go-tools" in data:
+            json_data["go-tools"] = data["go-tools"]
+        if "go-proxy" in data:
+            json_data["go-proxy"] = data["go-proxy"]
+        json_data["extensions"].update(data["extensions"])
+        inventory.files.update(fragment["inventory"])
+
+    # sort the extensions, since shards are built concurrently
+    json_data["extensions"] = dict(sorted(json_data["extensions"].items()))
+
+    # reconcile the inventory with the copied files
+    inventory.scan()
+    for path in artifact_paths(json_data):
+        if path not in inventory:
+            logging.warning("missing artifact: %s", path)
+
+    json_data["generation"] = inventory.generation + 1
+    write_data(root, json_data)
+    print(f"{len(fragments)} shards merged, {len(json_data['extensions'])} extensions")
+
+    finish_sync(args, inventory, not args.no_assets, json_data)
+
+
+def start_server(web_root, port):
+    """
+    serve the mirror from a background thread
+    """
+
+    import http.server
+    import socketserver
+
+    class ThreadingHTTPServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+        daemon_threads = True
+
+    logging.info("running HTTP server for %s port %d", web_root, port)
+
+    if sys.version_info.major == 3 and sys.version_info.minor <= 6:
+        os.chdir(web_root)
+        handler_class = http.server.SimpleHTTPRequestHandler
+    else:
+        handler_class = partial(
+            http.server.SimpleHTTPRequestHandler, directory=web_root
+        )
+    httpd = ThreadingHTTPServer(("", port), handler_class)
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    return httpd
 
 
 def server(web_root, port):
@@ -874,7 +2230,6 @@ def server(web_root, port):
     """
 
     import http.server
-    from functools import partial
 
     logging.info("running HTTP server for %s port %d", web_root, port)
 
@@ -894,6 +2249,15 @@ def main():
     """
 
     parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "command",
+        help="sync the mirror (default), merge the shard fragments,"
+        " export or import a delta bundle",
+        nargs="?",
+        choices=["sync", "merge", "export", "import"],
+        default="sync",
+    )
+    parser.add_argument("bundle", help="volumes of the bundle to import", nargs="*")
     parser.add_argument(
         "-v", "--verbose", help="increase verbosity", action="store_true"
     )
@@ -904,6 +2268,22 @@ def main():
     parser.add_argument(
         "--no-golang", help="do not download Go packages", action="store_true"
     )
+    parser.add_argument(
+        "--extract",
+        help="publish the extensions extracted, for the copy install of code-tool",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--shard",
+        help="sync only the part i of N of the extension list",
+        type=parse_shard,
+        metavar="i/N",
+    )
+    parser.add_argument(
+        "--no-dependencies",
+        help="do not download the dependencies and the extension pack members",
+        action="store_true",
+    )
     parser.add_argument("-e", "--engine", help="set the required engine version")
     parser.add_argument(
         "-k",
@@ -914,6 +2294,23 @@ def main():
         nargs="?",
         const=10,
     )
+    parser.add_argument(
+        "--quota",
+        help="keep the old versions while the mirror fits into SIZE (e.g. 200G)",
+        type=parse_size,
+        metavar="SIZE",
+    )
+    parser.add_argument(
+        "--keep-accessed",
+        help="keep the old versions downloaded in the last DAYS days",
+        type=int,
+        metavar="DAYS",
+    )
+    parser.add_argument(
+        "--access-log",
+        help="web server log of the mirror, to know when the versions were downloaded",
+        metavar="FILE",
+    )
     parser.add_argument(
         "-Y",
         "--yaml",
@@ -930,9 +2327,101 @@ def main():
     )
     parser.add_argument("--cache", help="enable Requests cache", action="store_true")
     parser.add_argument("-r", "--root", help="set the root directory")
+    parser.add_argument(
+        "--storage",
+        help="store the mirror into an S3-compatible bucket instead of the root"
+        " directory, which is only used as work directory",
+        metavar="s3://BUCKET/PREFIX",
+    )
     parser.add_argument("-s", "--server", help="HTTP server", action="store_true")
+    parser.add_argument(
+        "--verify",
+        help="verify the artifacts and download again the corrupted ones",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--force",
+        help="verify all artifacts, even the already verified ones",
+        action="store_true",
+    )
+    parser.add_argument(
+        "-d",
+        "--daemon",
+        help="sync periodically, only downloading the changes",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--interval",
+        help="delay between two syncs in daemon mode (default: %(default)s s)",
+        type=int,
+        metavar="SECONDS",
+        default=3600,
+    )
+    parser.add_argument(
+        "--jitter",
+        help="random variation of the delay (default: %(default)s s)",
+        type=int,
+        metavar="SECONDS",
+        default=300,
+    )
+    parser.add_argument(
+        "--serve",
+        help="serve the mirror over HTTP in daemon mode",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--atomic",
+        help="sync into a new generation of the root directory, published"
+        " atomically (the root directory becomes a symbolic link)",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--keep-generations",
+        help="number of previous generations to keep (default: %(default)s)",
+        type=int,
+        metavar="N",
+        default=1,
+    )
     parser.add_argument("-p", "--port", help="HTTP port", type=int, default=8000)
     parser.add_argument("-n", "--dry-run", help="dry run", action="store_true")
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        help="number of concurrent downloads (default: %(default)s)",
+        type=parse_jobs,
+        default=4,
+    )
+    parser.add_argument(
+        "--events",
+        help="progress event stream format",
+        choices=["text", "jsonl"],
+        default="text",
+    )
+    parser.add_argument(
+        "--events-output",
+        help="write the progress events into a file (default: stdout)",
+        metavar="FILE",
+        default="-",
+    )
+    parser.add_argument(
+        "--since",
+        help="export the changes after this generation (default: %(default)s, all)",
+        type=int,
+        metavar="GENERATION",
+        default=0,
+    )
+    parser.add_argument(
+        "-o",
+        "--output",
+        help="bundle file, - for stdout (default: vscode-dl-SINCE-GENERATION.tar)",
+        metavar="FILE",
+    )
+    parser.add_argument(
+        "--volume-size",
+        help="split the bundle into volumes of at most SIZE (e.g. 4G)",
+        type=parse_size,
+        metavar="SIZE",
+    )
 
     args = parser.parse_args()
 
@@ -951,29 +2440,55 @@ def main():
         )
 
     if args.cache:
+        import requests_cache
+
+        global _cache_installed
+
         # install a static cache (for developping and comfort reasons)
         expire_after = datetime.timedelta(hours=1)
         requests_cache.install_cache(
             "cache", allowable_methods=("GET", "POST"), expire_after=expire_after
         )
         requests_cache.core.remove_expired_responses()
+        _cache_installed = True
 
     args.conf = os.path.abspath(args.conf)
     if not os.path.isfile(args.conf):
-        args.conf = pkg_resources.resource_filename(__name__, "extensions.yaml")
+        args.conf = str(resource_path("extensions.yaml"))
         logging.debug(f"using default conf {args.conf}")
 
-    if args.root is None:
+    # the configuration is parsed only if it is needed
+    if args.root is None or not args.server:
         try:
-            args.root = yaml.load(open(args.conf), Loader=yaml.BaseLoader)["web_root"]
-        except Exception:
-            args.root = "web"  # default directory
+            args.config = Config.load(args.conf)
+        except FileNotFoundError:
+            logging.debug("no configuration file, using the defaults")
+            args.config = Config()
+        except Exception as e:
+            # an invalid configuration would empty the mirror
+            logging.error("cannot read %s: %s", args.conf, e)
+            exit(2)
+
+    if args.root is None:
+        args.root = args.config.web_root or "web"  # default directory
     args.root = os.path.abspath(args.root)
 
     if os.path.isdir(args.root) is False:
         logging.error("directory does not exist: %s", args.root)
         exit(2)
 
+    global _storage
+
+    try:
+        _storage = open_storage(args.storage, args.root)
+    except RuntimeError as e:
+        logging.error("%s", e)
+        exit(2)
+
+    if args.atomic and (not _storage.local or args.shard):
+        logging.error("--atomic requires a local root directory and no shard")
+        exit(2)
+
     # action 0: run http server
     if args.server:
         return server(args.root, args.port)
@@ -988,17 +2503,282 @@ def main():
         return print_conf(args)
 
     # action 3: download code/vsix and assets
-    download_code_vsix(args)
+    if args.command == "merge":
+        action = merge
+    elif args.command == "export":
+        action = export
+    elif args.command == "import":
+        action = import_bundle
+    elif args.verify:
+        action = check_mirror
+    elif args.daemon:
+        action = daemon
+    else:
+        action = sync_once
+    if configure_events(args.events, args.events_output):
+        # the event stream owns stdout: human readable progress goes to stderr
+        with contextlib.redirect_stdout(sys.stderr):
+            action(args)
+    else:
+        action(args)
+
+
+def read_catalog(root):
+    """
+    return the catalog of the web root, or None if there is none
+    """
+    try:
+        return json.loads(get_storage().read_bytes(pathlib.Path(root) / "data.json"))
+    except (OSError, ValueError):
+        return None
+
+
+def sync_once(args):
+    """
+    sync the mirror once: nothing is written if nothing has changed since the
+    catalog of the web root
+    """
+
+    # a shard compares its catalog with the merged one: it is always rewritten
+    previous = None if args.shard else read_catalog(args.root)
+    sync(args, previous)
+
 
-    if args.keep is not None:
-        purge("code", args.keep)
-        purge("vsix", args.keep)
+def sync(args, previous=None, inventory=None):
+    """
+    download code/vsix and assets
+    return the catalog, or None if nothing has changed since `previous`
+    """
+
+    if args.atomic:
+        return sync_generation(args, previous, inventory)
+
+    if inventory is None:
+        inventory = Inventory(args.root, get_storage())
+        inventory.load()
+        inventory.scan()
+
+    json_data = download_code_vsix(args, previous, inventory)
+    if json_data is None:
+        logging.info("catalog is up to date")
+
+    if args.shard:
+        # purge and assets are done once the shards are merged
+        return json_data
+
+    # the daemon downloads the assets at startup
+    assets = not args.no_assets and (previous is None or not args.daemon)
+    if json_data is None:
+        # the retention policy and the assets may have changed anyway
+        finish_sync(args, inventory, assets, previous, changed=False)
     else:
-        purge("code", 0)
-        purge("vsix", 0)
+        finish_sync(args, inventory, assets, json_data)
+
+    return json_data
+
+
+def sync_generation(args, previous=None, inventory=None):
+    """
+    sync into a new generation of the web root, then publish it atomically
+    the files of the previous generation are not modified
+    """
+
+    global _storage
+
+    root = args.root
+    storage = get_storage()
+    generations = Generations(root, args.keep_generations)
+    work = generations.prepare()
 
-    if not args.no_assets:
+    if inventory is None:
+        inventory = Inventory(work)
+        inventory.load()
+        inventory.scan()
+    generation = inventory.generation
+
+    # the sync works in the new generation
+    args.root = str(work)
+    _storage = LocalStorage(work)
+    inventory.root, inventory.storage = work, _storage
+    try:
+        args.atomic = False
+        json_data = sync(args, previous, inventory)
+        if inventory.generation == generation and generations.is_modified(
+            [INVENTORY_FILE]
+        ):
+            # new assets: they are published in a generation of their own
+            inventory.publish()
+            inventory.save()
+    except BaseException:
+        generations.discard()
+        raise
+    finally:
+        args.atomic = True
+        args.root = root
+        _storage = storage
+        inventory.root, inventory.storage = pathlib.Path(root), storage
+
+    if inventory.generation == generation:
+        generations.discard()
+    else:
+        generations.publish(inventory.generation)
+        events.phase_done("publish")
+
+    return json_data
+
+
+def finish_sync(args, inventory=None, assets=True, json_data=None, changed=True):
+    """
+    purge the old versions, download the assets and save the inventory
+    a new generation is published if the catalog has `changed` or if old
+    versions have been purged
+    """
+
+    root = pathlib.Path(args.root)
+
+    if inventory is None:
+        inventory = Inventory(root, get_storage())
+        inventory.load()
+        inventory.scan()
+
+    unlink, freed = purge(args, inventory, json_data)
+    if unlink:
+        print(f"{len(unlink)} old version(s) purged, {format_size(freed)} freed")
+    events.emit("purged", files=len(unlink), bytes=freed)
+    events.phase_done("purge")
+
+    if assets:
         download_assets(args.root)
+        events.phase_done("assets")
+
+    if changed or unlink:
+        generation = inventory.publish()
+        logging.info("generation %d published", generation)
+    inventory.save()
+
+
+def export(args):
+    """
+    write a bundle with the changes of the mirror since a generation
+    """
+
+    if not get_storage().local:
+        logging.error("export requires a local web root")
+        exit(2)
+    if args.output == "-" and (args.volume_size or args.events_output == "-"):
+        logging.error("the bundle and the volumes or the events cannot share stdout")
+        exit(2)
+
+    inventory = Inventory(args.root)
+    inventory.load()
+    bundle.export_bundle(
+        args.root, inventory, args.since, args.output, args.volume_size
+    )
+    events.phase_done("export")
+
+
+def import_bundle(args):
+    """
+    apply a bundle exported from another mirror
+    """
+
+    if not get_storage().local:
+        logging.error("import requires a local web root")
+        exit(2)
+    if not args.bundle:
+        logging.error("no bundle to import")
+        exit(2)
+
+    inventory = Inventory(args.root)
+    inventory.load()
+    try:
+        generation = bundle.import_bundles(args.root, args.bundle, inventory.generation)
+    except (OSError, ValueError) as e:
+        logging.error("cannot import the bundle: %s", e)
+        exit(1)
+    print(f"mirror at generation {generation} {CHECK_MARK}")
+    events.phase_done("import")
+
+
+def check_mirror(args):
+    """
+    verify the artifacts of the mirror, and download again the corrupted ones
+    """
+
+    root = pathlib.Path(args.root)
+
+    if not get_storage().local:
+        logging.error("--verify requires a local web root")
+        exit(2)
+
+    inventory = Inventory(root)
+    inventory.load()
+    inventory.scan()
+
+    corrupted = verify.verify_mirror(root, inventory, args.jobs, args.force)
+    for path in corrupted:
+        if not args.dry_run:
+            verify.quarantine(root, path, inventory)
+    inventory.save()
+    events.phase_done("verify")
+
+    if corrupted:
+        print(f"{len(corrupted)} corrupted artifact(s) {HEAVY_BALLOT_X}")
+        if not args.dry_run:
+            # the quarantined artifacts are missing: the sync downloads them again
+            sync(args, None, inventory)
+    else:
+        print(f"{len(inventory)} artifacts {CHECK_MARK}")
+
+
+def daemon(args):
+    """
+    sync the mirror periodically: sessions, catalog and inventory stay in memory
+    between the runs, and only the changes are downloaded
+    """
+
+    storage = get_storage()
+    root = pathlib.Path(args.root)
+
+    if args.serve:
+        if storage.local:
+            start_server(args.root, args.port)
+        else:
+            logging.error("--serve requires a local web root")
+
+    inventory = Inventory(root, storage)
+    inventory.load()
+    inventory.scan()
+
+    previous = None
+    try:
+        previous = json.loads(storage.read_bytes(root / "data.json"))
+        # the assets are downloaded once, at startup
+        if not args.no_assets:
+            download_assets(args.root)
+    except (OSError, ValueError):
+        pass
+
+    while True:
+        if args.config.is_modified():
+            logging.info("reloading %s", args.conf)
+            try:
+                args.config = Config.load(args.conf)
+            except Exception as e:
+                # the file is read again at the next sync
+                logging.error("cannot read %s, configuration kept: %s", args.conf, e)
+
+        try:
+            json_data = sync(args, previous, inventory)
+            if json_data is not None:
+                previous = json_data
+        except Exception:
+            logging.exception("sync failed")
+
+        # spread the load when several mirrors poll the same servers
+        delay = max(args.interval + random.uniform(-args.jitter, args.jitter), 0)
+        logging.info("next sync in %d s", delay)
+        time.sleep(delay)
 
 
 def win_term():
@@ -0,0 +1,28 @@
+#! /bin/sh
+# check that an invalid configuration stops the sync before anything is written
+#   usage: tests/badconf.sh
+
+cd $(dirname $0)/../src
+
+tmp=$(mktemp -d)
+trap "rm -rf $tmp" EXIT
+mkdir $tmp/web
+
+failed=0
+for conf in 'queries: [{top: ten}]' \
+            'queries: [{top: 0}]' \
+            'queries: [{sort: installs}]' \
+            'queries: [{}]' \
+            'queries: [python]' \
+            'extensions: ['; do
+    echo "$conf" > $tmp/extensions.yaml
+    python3 -m vscode_dl.vscode_dl -c $tmp/extensions.yaml -r $tmp/web -n 2> /dev/null
+    rc=$?
+    if [ $rc -ne 2 ] || [ -n "$(ls -A $tmp/web)" ]; then
+        echo "not rejected (exit code $rc): $conf"
+        failed=1
+    fi
+done
+
+[ $failed -eq 0 ] && echo "invalid configurations rejected"
+exit $failed
@@ -0,0 +1,28 @@
+#! /bin/sh
+# check the cold start of vscode-dl
+#   usage: tests/importtime.sh [budget in ms]
+
+budget=${1:-100}
+
+cd $(dirname $0)/../src
+
+# the heavy modules should be imported lazily
+python3 -c '
+import sys
+before = set(sys.modules)
+import vscode_dl.vscode_dl
+heavy = {"requests", "requests_cache", "yaml", "dateutil", "zipfile", "asyncio", "http.server", "pkg_resources"}
+loaded = sorted(heavy.intersection(set(sys.modules) - before))
+if loaded:
+    sys.exit("eagerly imported: " + " ".join(loaded))
+' || exit 1
+
+# compile once, then measure the import of the main module (in microseconds)
+python3 -c 'import vscode_dl.vscode_dl'
+us=$(python3 -X importtime -c 'import vscode_dl.vscode_dl' 2>&1 | awk -F'|' '/ vscode_dl.vscode_dl$/ { print $2 + 0 }')
+
+echo "import time: $((us / 1000)) ms (budget: ${budget} ms)"
+if [ $((us / 1000)) -gt ${budget} ]; then
+    echo "import time over budget"
+    exit 1
+fi